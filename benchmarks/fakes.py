@@ -0,0 +1,234 @@
+"""
+Dobles locales de la API de Gemini para medir el servicio sin red ni cuota.
+
+FakeGenaiClient imita la parte de google.genai.Client que usa main.py:
+models.generate_content / generate_content_stream / embed_content, sus
+equivalentes asíncronos en client.aio y caches.create. Las respuestas salen
+de ejemplo_output.json (válidas) y de error.json / truncados (malformadas).
+"""
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from types import SimpleNamespace
+
+import httpx
+from google.genai import errors
+
+ROOT = Path(__file__).resolve().parent.parent
+FIXTURE_CURRICULUM = Path(__file__).resolve().parent / "fixtures" / "curriculo_texto.txt"
+EXAMPLE_LESSON_TEXT = (ROOT / "ejemplo_output.json").read_text(encoding="utf-8")
+EXAMPLE_LESSON = json.loads(EXAMPLE_LESSON_TEXT)
+ERROR_SAMPLE_RAW = json.loads((ROOT / "error.json").read_text(encoding="utf-8"))["raw"]
+
+
+class FakeConfig:
+    """Perfil de la API simulada. Los tiempos están en segundos."""
+
+    def __init__(self, latency=1.5, jitter=0.25, first_token=0.4, chunk_chars=400,
+                 malformed_rate=0.0, error_rate=0.0, embed_latency=0.08, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.first_token = first_token
+        self.chunk_chars = chunk_chars
+        self.malformed_rate = malformed_rate
+        self.error_rate = error_rate
+        self.embed_latency = embed_latency
+        self.seed = seed
+
+
+def contents_text(contents):
+    if isinstance(contents, str):
+        return contents
+    return " ".join(str(item) for item in contents or [])
+
+
+def usage_metadata(prompt, output):
+    prompt_tokens = max(1, len(prompt) // 4)
+    output_tokens = max(1, len(output) // 4)
+    return SimpleNamespace(
+        prompt_token_count=prompt_tokens,
+        candidates_token_count=output_tokens,
+        cached_content_token_count=0,
+        total_token_count=prompt_tokens + output_tokens,
+    )
+
+
+def overloaded_error():
+    body = {"error": {"code": 503, "message": "The model is overloaded.", "status": "UNAVAILABLE"}}
+    return errors.ServerError(503, httpx.Response(503, json=body))
+
+
+class FakeEmbeddingModel:
+    """Embeddings deterministas: bolsa de palabras con hashing a `dim` dimensiones.
+    Textos con vocabulario común quedan cerca, suficiente para ejercitar la búsqueda."""
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def embed(self, text):
+        vector = [0.0] * self.dim
+        for token in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dim
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+
+def schema_subset(value, schema):
+    """Recorta `value` a las propiedades pedidas en un response_schema parcial."""
+    if not isinstance(schema, dict) or schema.get("type") != "OBJECT" or not isinstance(value, dict):
+        return value
+    return {key: schema_subset(value.get(key), sub) for key, sub in schema["properties"].items()}
+
+
+class FakeGenaiClient:
+    """Cliente falso con latencias configurables, streaming por trozos y una tasa
+    de salidas malformadas o errores 503. Cuenta las llamadas en `calls`."""
+
+    def __init__(self, config=None, embedding_model=None):
+        self.config = config or FakeConfig()
+        self.embedding_model = embedding_model or FakeEmbeddingModel()
+        self.calls = Counter()
+        self._rng = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self.models = FakeModels(self)
+        self.caches = FakeCaches()
+        self.aio = SimpleNamespace(models=FakeAsyncModels(self), caches=self.caches)
+
+    # --- comportamiento aleatorio reproducible ---
+    def _random(self):
+        with self._lock:
+            return self._rng.random()
+
+    def generation_latency(self):
+        spread = (self._random() * 2 - 1) * self.config.jitter
+        return max(0.0, self.config.latency * (1 + spread))
+
+    def should_fail(self):
+        return self.config.error_rate and self._random() < self.config.error_rate
+
+    def lesson_text(self, config):
+        """Texto que devolvería el modelo: lección completa, secciones o salida malformada."""
+        schema = getattr(config, "response_schema", None)
+        if isinstance(schema, dict) and schema.get("properties", {}).keys() != EXAMPLE_LESSON.keys():
+            return json.dumps(schema_subset(EXAMPLE_LESSON, schema), ensure_ascii=False)
+        if self.config.malformed_rate and self._random() < self.config.malformed_rate:
+            variant = self._random()
+            if variant < 0.5:
+                # truncado a mitad de la respuesta (límite de tokens)
+                return EXAMPLE_LESSON_TEXT[: int(len(EXAMPLE_LESSON_TEXT) * (0.3 + 0.6 * self._random()))]
+            if variant < 0.8:
+                return ERROR_SAMPLE_RAW + "\nEspero que esta sesión te sea útil."
+            return "Lo siento, no puedo generar la sesión en este momento."
+        return EXAMPLE_LESSON_TEXT
+
+    def chunks(self, text):
+        size = max(1, self.config.chunk_chars)
+        return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+    def embed_response(self, contents):
+        texts = [contents] if isinstance(contents, str) else list(contents)
+        return SimpleNamespace(embeddings=[
+            SimpleNamespace(values=self.embedding_model.embed(text)) for text in texts
+        ])
+
+
+class FakeModels:
+    def __init__(self, client):
+        self._client = client
+
+    def generate_content(self, model, contents, config=None):
+        client = self._client
+        client.calls["generate_content"] += 1
+        time.sleep(client.generation_latency())
+        if client.should_fail():
+            raise overloaded_error()
+        text = client.lesson_text(config)
+        return SimpleNamespace(text=text, usage_metadata=usage_metadata(contents_text(contents), text))
+
+    def generate_content_stream(self, model, contents, config=None):
+        client = self._client
+        client.calls["generate_content_stream"] += 1
+        text = client.lesson_text(config)
+        pieces = client.chunks(text)
+        total = client.generation_latency()
+        time.sleep(min(total, client.config.first_token))
+        if client.should_fail():
+            raise overloaded_error()
+        step = max(0.0, total - client.config.first_token) / len(pieces)
+        for i, piece in enumerate(pieces):
+            if i:
+                time.sleep(step)
+            last = i == len(pieces) - 1
+            yield SimpleNamespace(
+                text=piece,
+                usage_metadata=usage_metadata(contents_text(contents), text) if last else None,
+            )
+
+    def embed_content(self, model, contents, config=None):
+        client = self._client
+        client.calls["embed_content"] += 1
+        time.sleep(client.config.embed_latency)
+        return client.embed_response(contents)
+
+
+class FakeAsyncModels:
+    def __init__(self, client):
+        self._client = client
+
+    async def generate_content(self, model, contents, config=None):
+        client = self._client
+        client.calls["generate_content"] += 1
+        await asyncio.sleep(client.generation_latency())
+        if client.should_fail():
+            raise overloaded_error()
+        text = client.lesson_text(config)
+        return SimpleNamespace(text=text, usage_metadata=usage_metadata(contents_text(contents), text))
+
+    async def generate_content_stream(self, model, contents, config=None):
+        client = self._client
+        client.calls["generate_content_stream"] += 1
+        text = client.lesson_text(config)
+        pieces = client.chunks(text)
+        total = client.generation_latency()
+
+        async def stream():
+            await asyncio.sleep(min(total, client.config.first_token))
+            if client.should_fail():
+                raise overloaded_error()
+            step = max(0.0, total - client.config.first_token) / len(pieces)
+            for i, piece in enumerate(pieces):
+                if i:
+                    await asyncio.sleep(step)
+                last = i == len(pieces) - 1
+                yield SimpleNamespace(
+                    text=piece,
+                    usage_metadata=usage_metadata(contents_text(contents), text) if last else None,
+                )
+
+        return stream()
+
+    async def embed_content(self, model, contents, config=None):
+        client = self._client
+        client.calls["embed_content"] += 1
+        await asyncio.sleep(client.config.embed_latency)
+        return client.embed_response(contents)
+
+
+class FakeCaches:
+    """Context caching simulado: devuelve un nombre de caché sin coste."""
+
+    def __init__(self):
+        self.created = 0
+
+    def create(self, model, config=None):
+        self.created += 1
+        return SimpleNamespace(name=f"cachedContents/fake-{self.created}", model=model)
@@ -0,0 +1,70 @@
+"""
+Carga main.py en modo offline para los benchmarks.
+
+main.py lee su configuración de variables de entorno al importarse, así que
+load_service() las fija antes del import: índice y SQLite en un directorio
+temporal, currículo desde benchmarks/fixtures y un FakeGenaiClient en lugar
+del cliente real.
+"""
+import os
+import statistics
+import sys
+import tempfile
+
+from benchmarks.fakes import FIXTURE_CURRICULUM, ROOT, FakeConfig, FakeGenaiClient
+
+
+def load_service(fake_client=None, workdir=None, **env):
+    """Importa main.py sin red y construye el índice con el currículo local.
+    `env` permite ajustar la configuración del servicio (p. ej. LESSON_CACHE_SIZE="0")."""
+    workdir = workdir or tempfile.mkdtemp(prefix="eduai-bench-")
+    os.environ.setdefault("GOOGLE_API_KEY", "offline-benchmark")
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+    os.environ["CHROMA_PATH"] = os.path.join(workdir, "chroma")
+    os.environ["DB_NAME"] = os.path.join(workdir, "lesson_memory.db")
+    os.environ["CURRICULUM_PATH"] = str(FIXTURE_CURRICULUM)
+    os.environ.setdefault("EMBED_REQUESTS_PER_MINUTE", "100000")
+    os.environ.update({key: str(value) for key, value in env.items()})
+    if str(ROOT) not in sys.path:
+        sys.path.insert(0, str(ROOT))
+
+    import main
+
+    main.client = fake_client or FakeGenaiClient(FakeConfig(latency=0, first_token=0, embed_latency=0))
+    main.curriculum_indexer.rebuild()
+    return main
+
+
+def teacher_message(i=0, titulo=None, contexto=None, grado=None, duracion="2 horas"):
+    """Mensaje del frontend con el formato que espera parse_teacher_message."""
+    temas = ["Fracciones", "Ecuaciones lineales", "Porcentajes", "Funciones cuadráticas",
+             "Área y perímetro", "Probabilidad", "Estadística descriptiva", "Proporcionalidad"]
+    contextos = ["Pesquero", "Rural/Agrícola", "Comercial", "Minero", "Turístico", "Urbano"]
+    competencias = ["Resuelve problemas de cantidad",
+                    "Resuelve problemas de regularidad, equivalencia y cambio",
+                    "Resuelve problemas de forma, movimiento y localización",
+                    "Resuelve problemas de gestión de datos e incertidumbre"]
+    return (
+        f"Título: {titulo or temas[i % len(temas)]}\n"
+        f"Docente: Docente {i}\n"
+        f"Fecha: 2025-04-{1 + i % 28:02d}\n"
+        f"Grado: {grado or 1 + i % 5}º Secundaria\n"
+        f"Sección: {'ABCDE'[i % 5]}\n"
+        f"Competencias: {competencias[i % len(competencias)]}\n"
+        f"Capacidades: Traduce cantidades a expresiones numéricas\n"
+        f"Ciclo: {'VI' if i % 5 < 2 else 'VII'}\n"
+        f"Contexto: {contexto or contextos[i % len(contextos)]}\n"
+        f"Duración: {duracion}\n"
+        f"Enfoque Transversal: Enfoque Ambiental\n"
+        f"Competencia Transversal: Gestiona su aprendizaje de manera autónoma\n"
+        f"Materiales: Pizarra, plumones, fichas de trabajo\n"
+    )
+
+
+def percentiles(values):
+    """p50, p95 y p99 de una lista de mediciones."""
+    if len(values) < 2:
+        value = values[0] if values else 0.0
+        return value, value, value
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return cuts[49], cuts[94], cuts[98]
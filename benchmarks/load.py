@@ -0,0 +1,99 @@
+"""
+Prueba de carga de extremo a extremo sobre /webhook.
+
+Uso:
+    python -m benchmarks.load --concurrency 1,8,32 --requests 200
+    python -m benchmarks.load --url http://localhost:8000 --concurrency 4
+
+Sin --url levanta la app en el mismo proceso (httpx.ASGITransport) con un
+FakeGenaiClient cuya latencia, tasa de salidas malformadas y de errores 503 se
+configuran por argumentos. Con --url apunta a un servidor ya desplegado.
+Para cada nivel de concurrencia reporta throughput, p50/p95/p99 y códigos HTTP.
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+import httpx
+
+from benchmarks.fakes import FakeConfig, FakeGenaiClient
+from benchmarks.harness import load_service, percentiles, teacher_message
+
+
+async def run_level(http, concurrency, total, repeat_ratio, offset):
+    """Lanza `total` solicitudes con `concurrency` en vuelo a la vez."""
+    latencies = []
+    statuses = Counter()
+    pending = iter(range(total))
+
+    async def worker():
+        for i in pending:
+            # una fracción de solicitudes repite mensajes ya vistos (aciertos de caché)
+            repeated = repeat_ratio and (i % 100) < repeat_ratio * 100
+            message = teacher_message(i % 8 if repeated else offset + i, titulo=None if repeated else f"Tema {offset + i}")
+            start = time.perf_counter()
+            try:
+                response = await http.post("/webhook", data={"Body": message, "From": f"bench-{i % 50}"})
+                payload = response.json() if response.status_code == 200 else {}
+                status = "parse_error" if "error" in payload else response.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - start, latencies, statuses
+
+
+async def run(args):
+    if args.url:
+        transport, base_url = None, args.url
+    else:
+        fake = FakeGenaiClient(FakeConfig(
+            latency=args.latency, jitter=args.jitter, first_token=args.first_token,
+            malformed_rate=args.malformed_rate, error_rate=args.error_rate,
+            embed_latency=args.embed_latency, seed=args.seed,
+        ))
+        service = load_service(fake)
+        # los errores de la app se cuentan como 500, igual que detrás de uvicorn
+        transport = httpx.ASGITransport(app=service.app, raise_app_exceptions=False)
+        base_url = "http://bench"
+
+    print(f"{'concurrencia':>12} {'solicitudes':>11} {'req/s':>8} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8}  códigos")
+    offset = 0
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout) as http:
+        for concurrency in args.concurrency:
+            elapsed, latencies, statuses = await run_level(
+                http, concurrency, args.requests, args.repeat_ratio, offset,
+            )
+            offset += args.requests
+            p50, p95, p99 = percentiles(latencies)
+            codes = ", ".join(f"{code}: {count}" for code, count in sorted(statuses.items(), key=str))
+            print(f"{concurrency:>12} {len(latencies):>11} {len(latencies) / elapsed:>8.1f} "
+                  f"{p50:>8.3f} {p95:>8.3f} {p99:>8.3f}  {codes}")
+    if not args.url:
+        print(f"Llamadas a la API simulada: {dict(fake.calls)}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="servidor ya desplegado; por defecto la app en proceso")
+    parser.add_argument("--concurrency", default="1,8,32",
+                        type=lambda value: [int(c) for c in value.split(",")])
+    parser.add_argument("--requests", type=int, default=100, help="solicitudes por nivel de concurrencia")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="fracción de mensajes repetidos")
+    parser.add_argument("--latency", type=float, default=1.5, help="segundos por generación simulada")
+    parser.add_argument("--jitter", type=float, default=0.25)
+    parser.add_argument("--first-token", type=float, default=0.4)
+    parser.add_argument("--embed-latency", type=float, default=0.08)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fracción de respuestas 503")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,68 @@
+"""
+Micro-benchmarks de las etapas locales del pipeline (sin red).
+
+Uso:
+    python -m benchmarks.micro [--iterations 2000]
+
+Mide parse_teacher_message, build_prompt, clean_model_output (salida válida,
+con code-fences y truncada), IncrementalSectionParser y la recuperación
+(BM25 solo y búsqueda híbrida con el embedding ya calculado).
+"""
+import argparse
+import statistics
+import time
+
+from benchmarks.fakes import ERROR_SAMPLE_RAW, EXAMPLE_LESSON_TEXT
+from benchmarks.harness import load_service, percentiles, teacher_message
+
+
+def measure(name, fn, iterations):
+    for _ in range(min(iterations, 50)):  # calentamiento
+        fn()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    p50, p95, p99 = percentiles(samples)
+    print(f"{name:<40} {statistics.fmean(samples) * 1e6:>10.1f} {p50 * 1e6:>10.1f} "
+          f"{p95 * 1e6:>10.1f} {p99 * 1e6:>10.1f}")
+
+
+def feed_in_chunks(main, text, size=400):
+    parser = main.IncrementalSectionParser()
+    for i in range(0, len(text), size):
+        parser.feed(text[i:i + size])
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    main = load_service()
+    message = teacher_message(3)
+    inputs = main.parse_teacher_message(message)
+    query_text = main.build_query_text(inputs)
+    docs = main.retrieve_documents(query_text)
+    query_embedding = main.embed_query(query_text)
+    fenced = f"```json\n{EXAMPLE_LESSON_TEXT}\n```"
+    truncated = EXAMPLE_LESSON_TEXT[: len(EXAMPLE_LESSON_TEXT) * 2 // 3]
+    n = args.iterations
+
+    print(f"{'etapa':<40} {'media µs':>10} {'p50 µs':>10} {'p95 µs':>10} {'p99 µs':>10}")
+    measure("parse_teacher_message", lambda: main.parse_teacher_message(message), n)
+    measure("build_prompt", lambda: main.build_prompt(inputs, docs), n)
+    measure("clean_model_output (válida)", lambda: main.clean_model_output(EXAMPLE_LESSON_TEXT), n)
+    measure("clean_model_output (code-fence)", lambda: main.clean_model_output(fenced), n)
+    measure("clean_model_output (error.json)", lambda: main.clean_model_output(ERROR_SAMPLE_RAW), n)
+    measure("clean_model_output (truncada)", lambda: main.clean_model_output(truncated), n)
+    measure("IncrementalSectionParser (400 c/trozo)", lambda: feed_in_chunks(main, EXAMPLE_LESSON_TEXT), n)
+    keywords = main.curriculum_indexer.active.keywords
+    measure("BM25Index.search", lambda: keywords.search(query_text, 10), n)
+    measure("retrieve_documents (híbrida)",
+            lambda: main.retrieve_documents(query_text, query_embedding=query_embedding), max(1, n // 10))
+
+
+if __name__ == "__main__":
+    main_cli()
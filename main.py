@@ -1,76 +1,673 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import sqlite3
-import chromadb
-from google import genai
-from google.genai import types
 from google.api_core import retry
 import os
 import re
+import hashlib
 import json
 import requests
-import time 
+import time
+import asyncio
+import threading
+import queue
+import atexit
+import copy
+import unicodedata
+from collections import Counter, OrderedDict, deque
+import heapq
+import math
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+from contextlib import aclosing, asynccontextmanager, contextmanager
+import random
+import bisect
+import uuid
+import zlib
+import numpy as np
 
 # ========================
 # Configuración de Gemini
 # ========================
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-client = genai.Client(api_key=GOOGLE_API_KEY)
+
+class LazyResource:
+    """Recurso que se construye en su primer uso (cliente de Gemini, SQLite, Chroma).
+    Delegar los atributos permite usarlo como el objeto real (`client.models...`).
+    Si la construcción falla, el error queda en `error` y se reintenta en el siguiente uso."""
+
+    def __init__(self, name, factory):
+        self.name = name
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+        self.error = None
+
+    def get(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    try:
+                        self._instance = self._factory()
+                        self.error = None
+                    except Exception as e:
+                        self.error = str(e)
+                        raise
+        return self._instance
+
+    @property
+    def loaded(self):
+        return self._instance is not None
+
+    def status(self):
+        if self._instance is not None:
+            return "listo"
+        return f"error: {self.error}" if self.error else "pendiente"
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+def create_genai_client():
+    # google.genai tarda ~0.5 s en importarse: se difiere hasta la primera llamada
+    from google import genai
+    return genai.Client(api_key=GOOGLE_API_KEY)
+
+client = LazyResource("gemini", create_genai_client)
+
+# ========================
+# Métricas (formato Prometheus)
+# ========================
+# Con REQUEST_LOG=1 cada generación escribe una línea JSON con sus tiempos por etapa
+REQUEST_LOG = os.getenv("REQUEST_LOG", "0") == "1"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+TOKEN_BUCKETS = (250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+def format_labels(labelnames, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class CounterMetric:
+    """Contador Prometheus con etiquetas, thread-safe."""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class HistogramMetric:
+    """Histograma Prometheus con etiquetas, thread-safe."""
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        self._series = {}  # etiquetas -> [conteos por bucket, suma, total]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total_sum, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = format_labels(self.labelnames, key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = format_labels(self.labelnames, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total_sum}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+STAGE_SECONDS = HistogramMetric(
+    "eduai_stage_seconds", "Duración de cada etapa de la generación", labelnames=("stage",)
+)
+REQUEST_SECONDS = HistogramMetric(
+    "eduai_request_seconds", "Duración total de la generación por endpoint", labelnames=("endpoint", "outcome")
+)
+EMBEDDING_SECONDS = HistogramMetric(
+    "eduai_embedding_seconds", "Duración de cada llamada a embed_content", labelnames=("task",)
+)
+OUTPUT_TOKENS = HistogramMetric(
+    "eduai_output_tokens", "Tokens de salida por llamada a Gemini", buckets=TOKEN_BUCKETS
+)
+TOKENS_TOTAL = CounterMetric("eduai_tokens_total", "Tokens reportados en usage_metadata", labelnames=("kind",))
+PARSE_FAILURES = CounterMetric("eduai_parse_failures_total", "Salidas del modelo que no se pudieron parsear")
+JSON_REPAIRS = CounterMetric("eduai_json_repairs_total", "Salidas del modelo parseadas tras repair_json")
+SECTION_REGENERATIONS = CounterMetric(
+    "eduai_section_regenerations_total", "Secciones regeneradas por faltar o ser inválidas"
+)
+SECTION_REGENERATION_FAILURES = CounterMetric(
+    "eduai_section_regeneration_failures_total",
+    "Regeneraciones de secciones que fallaron (la sesión se entrega parcial)", labelnames=("reason",)
+)
+API_RETRIES = CounterMetric("eduai_api_retries_total", "Reintentos de llamadas a la API de Gemini", labelnames=("call",))
+GENERATION_CALLS = CounterMetric(
+    "eduai_generation_calls_total", "Llamadas de generación por modelo y resultado", labelnames=("model", "outcome")
+)
+HEDGED_REQUESTS = CounterMetric(
+    "eduai_generation_hedges_total", "Segundas llamadas lanzadas por hedging", labelnames=("model",)
+)
+CIRCUIT_OPENINGS = CounterMetric(
+    "eduai_circuit_openings_total", "Aperturas del circuit breaker por modelo", labelnames=("model",)
+)
+METRICS = [
+    STAGE_SECONDS, REQUEST_SECONDS, EMBEDDING_SECONDS, OUTPUT_TOKENS, TOKENS_TOTAL, PARSE_FAILURES,
+    JSON_REPAIRS, SECTION_REGENERATIONS, SECTION_REGENERATION_FAILURES, API_RETRIES, GENERATION_CALLS, HEDGED_REQUESTS, CIRCUIT_OPENINGS,
+]
+
+USAGE_FIELDS = {
+    "prompt": "prompt_token_count",
+    "output": "candidates_token_count",
+    "cached": "cached_content_token_count",
+    "total": "total_token_count",
+}
+
+class RequestTrace:
+    """Tiempos por etapa y tokens de una generación; alimenta las métricas y el log."""
+
+    def __init__(self, endpoint, session_id):
+        self.endpoint = endpoint
+        self.session_id = session_id
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.tokens = {}
+        self.cache = None
+        self.refinement = False
+
+    def observe(self, name, elapsed):
+        self.stages[name] = self.stages.get(name, 0.0) + elapsed
+        STAGE_SECONDS.observe(elapsed, stage=name)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def record_usage(self, response):
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None:
+            return
+        for kind, field in USAGE_FIELDS.items():
+            value = getattr(usage, field, None) or 0
+            if value:
+                self.tokens[kind] = self.tokens.get(kind, 0) + value
+                TOKENS_TOTAL.inc(value, kind=kind)
+        if getattr(usage, "candidates_token_count", None):
+            OUTPUT_TOKENS.observe(usage.candidates_token_count)
+
+    def finish(self, lesson_json=None, error=None):
+        """Cierra la traza. Sin sesión (excepción, 503, cliente desconectado) también se
+        registra, para que la latencia y la tasa de errores incluyan esas peticiones."""
+        if lesson_json is None:
+            outcome = "cancelled" if isinstance(error, (asyncio.CancelledError, GeneratorExit)) else "error"
+        elif "error" in lesson_json:
+            outcome = "error"
+        else:
+            outcome = "cache" if self.cache else ("refine" if self.refinement else "ok")
+        elapsed = time.perf_counter() - self.started
+        REQUEST_SECONDS.observe(elapsed, endpoint=self.endpoint, outcome=outcome)
+        if REQUEST_LOG:
+            print(json.dumps({
+                "event": "lesson",
+                "endpoint": self.endpoint,
+                "session_id": self.session_id,
+                "outcome": outcome,
+                "cache": self.cache,
+                "seconds": round(elapsed, 4),
+                "stages": {name: round(value, 4) for name, value in self.stages.items()},
+                "tokens": self.tokens,
+                **({"error": repr(error)} if lesson_json is None and error is not None else {}),
+            }, ensure_ascii=False))
+
+def count_retry(call):
+    """on_error para retry.Retry: cuenta cada reintento."""
+    return lambda error: API_RETRIES.inc(call=call)
 
 # ========================
 # Base de datos SQLite
 # ========================
-DB_NAME = "lesson_memory.db"
-conn = sqlite3.connect(DB_NAME, check_same_thread=False)
-cursor = conn.cursor()
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS lesson_history (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    session_id TEXT,
-    role TEXT,
-    content TEXT,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+DB_NAME = os.getenv("DB_NAME", "lesson_memory.db")
+# Con HISTORY_ASYNC_WRITES=1 el historial se escribe desde un hilo en segundo plano
+HISTORY_ASYNC_WRITES = os.getenv("HISTORY_ASYNC_WRITES", "0") == "1"
+# Retención: días que se conservan las sesiones y máximo por conversación (0 = sin límite)
+HISTORY_RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", "0"))
+HISTORY_MAX_PER_SESSION = int(os.getenv("HISTORY_MAX_PER_SESSION", "0"))
+# Cada cuántos segundos se aplica la retención y se compacta la base (0 = nunca)
+HISTORY_COMPACT_SECONDS = float(os.getenv("HISTORY_COMPACT_SECONDS", "86400"))
+
+# Campos del formulario docente (mismas claves que parse_teacher_message): una columna por campo
+LESSON_INPUT_FIELDS = (
+    "titulo", "docente", "fecha", "grado", "seccion", "competencias", "capacidades", "ciclo",
+    "contexto", "duracion", "enfoque_transversal", "competencia_transversal", "materiales",
 )
-""")
-conn.commit()
+LESSON_COLUMNS = ("session_id", "timestamp", *LESSON_INPUT_FIELDS, "status", "zdict_id", "lesson", "raw_output")
+# Sesión de ejemplo con la estructura y el vocabulario típicos: diccionario inicial de compresión
+ZDICT_SAMPLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ejemplo_output.json")
+ZDICT_MAX_BYTES = 32 * 1024  # zlib solo aprovecha los últimos 32 KB del diccionario
+
+def compact_json(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+def train_zdict(samples):
+    """Diccionario zlib a partir de sesiones de muestra, serializadas igual que se guardan."""
+    return "".join(compact_json(sample) for sample in samples).encode("utf-8")[-ZDICT_MAX_BYTES:]
+
+def default_zdict():
+    try:
+        with open(ZDICT_SAMPLE_PATH, encoding="utf-8") as f:
+            return train_zdict([json.load(f)])
+    except (OSError, ValueError):
+        return b""
+
+def utc_timestamp():
+    # mismo formato que CURRENT_TIMESTAMP de SQLite, para comparar con datetime('now', ...)
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+class HistoryStore:
+    """Historial de sesiones generadas en SQLite.
+
+    Cada sesión es una fila de `lessons`: las entradas del docente en columnas, la
+    sesión como JSON comprimido con zlib y un diccionario compartido (tabla `zdicts`,
+    así las filas se pueden leer aunque cambie el ejemplo) y la salida cruda del modelo
+    solo cuando no se pudo parsear. Usa una conexión por hilo en modo WAL (las lecturas
+    no bloquean a la escritura). Con `async_writes` las escrituras se encolan y un hilo
+    escritor las agrupa por lotes, así la persistencia no suma latencia a la respuesta.
+    `lesson_history` queda para mensajes sueltos; compact() migra a `lessons` las
+    ternas user/bot_raw/bot del formato anterior y aplica la retención."""
+
+    def __init__(self, path, async_writes=False, max_batch=64,
+                 retention_days=0, max_per_session=0, compact_every=0):
+        self.path = path
+        self.max_batch = max_batch
+        self.retention_days = retention_days
+        self.max_per_session = max_per_session
+        self._local = threading.local()
+        self._queue = None
+        self._insert_lesson = (
+            f"INSERT INTO lessons ({', '.join(LESSON_COLUMNS)}) "
+            f"VALUES ({', '.join('?' for _ in LESSON_COLUMNS)})"
+        )
+        conn = self._connection()
+        with conn:
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS lesson_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT,
+                role TEXT,
+                content TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+            """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_lesson_history_session ON lesson_history (session_id, id)"
+            )
+            conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS lessons (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                {", ".join(f"{field} TEXT" for field in LESSON_INPUT_FIELDS)},
+                status TEXT NOT NULL,
+                zdict_id INTEGER NOT NULL,
+                lesson BLOB,
+                raw_output BLOB
+            )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_lessons_session ON lessons (session_id, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_lessons_timestamp ON lessons (timestamp)")
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS zdicts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                zdict BLOB NOT NULL
+            )
+            """)
+        # varios workers pueden arrancar a la vez sobre una base nueva: el diccionario se
+        # siembra una sola vez bajo el lock de escritura y todos leen el mismo
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO zdicts (zdict) SELECT ? WHERE NOT EXISTS (SELECT 1 FROM zdicts)", (default_zdict(),)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        self._load_zdicts()
+        self._zdict_id = max(self._zdicts)
+        if async_writes:
+            self._queue = queue.Queue()
+            threading.Thread(target=self._writer_loop, name="history-writer", daemon=True).start()
+            atexit.register(self.flush)
+        if compact_every > 0:
+            threading.Thread(
+                target=self._compact_loop, args=(compact_every,), name="history-compact", daemon=True,
+            ).start()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            # antes que WAL: solo tiene efecto en una base nueva; compact() convierte las existentes
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # --- compresión ---
+    def _load_zdicts(self):
+        self._zdicts = dict(self._connection().execute("SELECT id, zdict FROM zdicts").fetchall())
+
+    def _zdict(self, zdict_id):
+        if zdict_id not in self._zdicts:
+            self._load_zdicts()  # escrito por otro proceso después de que este arrancó
+        return self._zdicts[zdict_id]
+
+    def _compress(self, text):
+        compressor = zlib.compressobj(9, zdict=self._zdicts[self._zdict_id])
+        return compressor.compress(text.encode("utf-8")) + compressor.flush()
+
+    def _decompress(self, blob, zdict_id):
+        decompressor = zlib.decompressobj(zdict=self._zdict(zdict_id))
+        return (decompressor.decompress(blob) + decompressor.flush()).decode("utf-8")
+
+    def _lesson_row(self, session_id, inputs, raw_output, lesson_json, timestamp=None):
+        failed = "error" in lesson_json
+        return (
+            session_id,
+            timestamp or utc_timestamp(),
+            *(inputs.get(field, "") for field in LESSON_INPUT_FIELDS),
+            "error" if failed else "ok",
+            self._zdict_id,
+            None if failed else self._compress(compact_json(lesson_json)),
+            self._compress(raw_output or "") if failed else None,  # la salida cruda solo sirve si falló
+        )
+
+    # --- escritura ---
+    def _write(self, messages=(), lessons=()):
+        conn = self._connection()
+        with conn:
+            if messages:
+                conn.executemany(
+                    "INSERT INTO lesson_history (session_id, role, content) VALUES (?, ?, ?)",
+                    messages,
+                )
+            if lessons:
+                conn.executemany(self._insert_lesson, lessons)
+
+    def _writer_loop(self):
+        while True:
+            batches = [self._queue.get()]
+            while len(batches) < self.max_batch:
+                try:
+                    batches.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(
+                    [row for messages, _ in batches for row in messages],
+                    [row for _, lessons in batches for row in lessons],
+                )
+            except Exception as e:
+                print(f"⚠️ Error guardando historial ({len(batches)} sesiones): {e}")
+            for _ in batches:
+                self._queue.task_done()
+
+    def _submit(self, messages, lessons):
+        if self._queue is not None:
+            self._queue.put((messages, lessons))
+        else:
+            self._write(messages, lessons)
+
+    def save_rows(self, rows):
+        """Guarda mensajes sueltos (session_id, role, content) en una transacción, o los encola."""
+        self._submit(list(rows), [])
+
+    def save_lesson(self, session_id, inputs, raw_output, lesson_json):
+        """Guarda una sesión generada; la compresión corre en el hilo que llama."""
+        self._submit([], [self._lesson_row(session_id, inputs, raw_output, lesson_json)])
+
+    def flush(self):
+        """Espera a que el hilo escritor vacíe la cola."""
+        if self._queue is not None:
+            self._queue.join()
+
+    # --- lectura ---
+    def get_recent_history(self, session_id, n_turns=3):
+        """Últimas `n_turns` sesiones de la conversación como pares (role, content):
+        user (entradas en JSON), bot_raw (solo si falló el parseo) y bot."""
+        rows = self._connection().execute(f"""
+            SELECT {", ".join(LESSON_INPUT_FIELDS)}, zdict_id, lesson, raw_output FROM lessons
+            WHERE session_id=?
+            ORDER BY id DESC LIMIT ?
+        """, (session_id, n_turns)).fetchall()
+        history = []
+        for row in reversed(rows):
+            zdict_id, lesson, raw_output = row[len(LESSON_INPUT_FIELDS):]
+            history.append(("user", json.dumps(dict(zip(LESSON_INPUT_FIELDS, row)), ensure_ascii=False)))
+            if raw_output is not None:
+                history.append(("bot_raw", self._decompress(raw_output, zdict_id)))
+            if lesson is not None:
+                history.append(("bot", self._decompress(lesson, zdict_id)))
+            else:
+                history.append(("bot", json.dumps({"error": LESSON_PARSE_ERROR}, ensure_ascii=False)))
+        return history
+
+    def get_last_lesson(self, session_id):
+        """Entradas y sesión de la última generación válida de la conversación, o (None, None)."""
+        row = self._connection().execute(f"""
+            SELECT {", ".join(LESSON_INPUT_FIELDS)}, zdict_id, lesson FROM lessons
+            WHERE session_id=? AND status='ok'
+            ORDER BY id DESC LIMIT 1
+        """, (session_id,)).fetchone()
+        if row is None:
+            return None, None
+        zdict_id, lesson = row[len(LESSON_INPUT_FIELDS):]
+        return dict(zip(LESSON_INPUT_FIELDS, row)), json.loads(self._decompress(lesson, zdict_id))
+
+    # --- retención y compactación ---
+    def _compact_loop(self, interval):
+        while True:
+            try:
+                self.compact()
+            except Exception as e:
+                print(f"⚠️ Error compactando el historial: {e}")
+            time.sleep(interval)
+
+    def _legacy_lesson(self, record):
+        """Fila de `lessons` a partir de una terna del formato anterior."""
+        try:
+            lesson_json = json.loads(record["bot"])
+        except ValueError:
+            lesson_json = None
+        if not isinstance(lesson_json, dict):
+            lesson_json = {"error": LESSON_PARSE_ERROR}
+        return self._lesson_row(
+            record["session_id"], record["inputs"], record.get("bot_raw"), lesson_json, record["timestamp"],
+        )
+
+    def migrate_legacy(self, chunk=500):
+        """Convierte las ternas user/bot_raw/bot de lesson_history en filas de `lessons`.
+        Cada lote se migra y borra en una transacción; si otro worker ya lo hizo, se descarta."""
+        conn = self._connection()
+        pending = {}  # session_id -> terna en curso (las filas de una sesión son consecutivas)
+        last_id = migrated = 0
+        while True:
+            rows = conn.execute("""
+                SELECT id, session_id, role, content, timestamp FROM lesson_history
+                WHERE id > ? AND role IN ('user', 'bot_raw', 'bot')
+                ORDER BY id LIMIT ?
+            """, (last_id, chunk)).fetchall()
+            if not rows:
+                return migrated
+            lessons, ids = [], []
+            for row_id, session_id, role, content, timestamp in rows:
+                last_id = row_id
+                if role == "user":
+                    try:
+                        inputs = json.loads(content)
+                    except ValueError:
+                        inputs = None
+                    if isinstance(inputs, dict):
+                        pending[session_id] = {
+                            "session_id": session_id, "inputs": inputs, "timestamp": timestamp, "ids": [row_id],
+                        }
+                    continue
+                record = pending.get(session_id)
+                if record is None:
+                    continue
+                record[role] = content
+                record["ids"].append(row_id)
+                if role == "bot":
+                    del pending[session_id]
+                    lessons.append(self._legacy_lesson(record))
+                    ids.extend(record["ids"])
+            if not lessons:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                deleted = conn.executemany("DELETE FROM lesson_history WHERE id = ?", [(i,) for i in ids]).rowcount
+                if deleted == len(ids):
+                    conn.executemany(self._insert_lesson, lessons)
+                    conn.commit()
+                    migrated += len(lessons)
+                else:
+                    conn.rollback()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def compact(self):
+        """Migra el formato anterior, aplica la retención y devuelve al disco el espacio libre."""
+        migrated = self.migrate_legacy()
+        conn = self._connection()
+        removed = 0
+        with conn:
+            if self.retention_days > 0:
+                cutoff = f"-{self.retention_days} days"
+                for table in ("lessons", "lesson_history"):
+                    removed += conn.execute(
+                        f"DELETE FROM {table} WHERE timestamp < datetime('now', ?)", (cutoff,)
+                    ).rowcount
+            if self.max_per_session > 0:
+                removed += conn.execute("""
+                    DELETE FROM lessons WHERE id IN (
+                        SELECT id FROM (
+                            SELECT id, ROW_NUMBER() OVER (PARTITION BY session_id ORDER BY id DESC) AS n
+                            FROM lessons
+                        ) WHERE n > ?
+                    )
+                """, (self.max_per_session,)).rowcount
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            conn.execute("PRAGMA incremental_vacuum").fetchall()
+        elif migrated or removed:
+            # base creada antes del formato comprimido: se reescribe una vez y pasa a auto_vacuum incremental
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        if migrated or removed:
+            print(f"🧹 Historial compactado: {migrated} sesiones migradas, {removed} filas eliminadas")
+        return {"migradas": migrated, "eliminadas": removed}
+
+history_store = LazyResource("historial", lambda: HistoryStore(
+    DB_NAME,
+    async_writes=HISTORY_ASYNC_WRITES,
+    retention_days=HISTORY_RETENTION_DAYS,
+    max_per_session=HISTORY_MAX_PER_SESSION,
+    compact_every=HISTORY_COMPACT_SECONDS,
+))
 
 def save_message(session_id, role, content):
-    cursor.execute(
-        "INSERT INTO lesson_history (session_id, role, content) VALUES (?, ?, ?)", 
-        (session_id, role, content)
-    )
-    conn.commit()
+    history_store.save_rows([(session_id, role, content)])
 
 def get_recent_history(session_id, n_turns=3):
-    cursor.execute("""
-        SELECT role, content FROM lesson_history 
-        WHERE session_id=? 
-        ORDER BY id DESC LIMIT ?
-    """, (session_id, n_turns*2))
-    rows = cursor.fetchall()
-    return list(reversed(rows))
+    return history_store.get_recent_history(session_id, n_turns)
 
 # ========================
 # ChromaDB con currículo escolar
 # ========================
-class GeminiEmbeddingFunction(chromadb.EmbeddingFunction):
-    document_mode = True
-    @retry.Retry(predicate=lambda e: isinstance(e, genai.errors.APIError) and e.code in {429,503})
-    def __call__(self, input):
-        task = "retrieval_document" if self.document_mode else "retrieval_query"
-        response = client.models.embed_content(
-            model="models/text-embedding-004",
-            contents=input,
-            config=types.EmbedContentConfig(task_type=task),
-        )
-        return [e.values for e in response.embeddings]
+EMBEDDING_MODEL = "models/text-embedding-004"
+CHROMA_PATH = os.getenv("CHROMA_PATH", "data/chroma")
+
+def is_retryable_api_error(e):
+    """429 (cuota) y 503 (sobrecarga) son transitorios y se reintentan."""
+    from google.genai import errors
+    return isinstance(e, errors.APIError) and e.code in {429,503}
 
-embed_fn = GeminiEmbeddingFunction()
-chroma_client = chromadb.Client()
-knowledge_db = chroma_client.get_or_create_collection(
-    name="curriculo_secundaria", embedding_function=embed_fn
+def embed_texts_once(texts, task_type):
+    """Una sola llamada a embed_content con varios `contents`, sin reintentos.
+    La tarea (retrieval_document / retrieval_query) se pasa en cada llamada:
+    no hay estado compartido entre la ingesta y las consultas. La ingesta la usa
+    directamente: cada reintento suyo vuelve a pasar por el token bucket."""
+    from google.genai import types
+    started = time.perf_counter()
+    response = client.models.embed_content(
+        model=EMBEDDING_MODEL,
+        contents=texts,
+        config=types.EmbedContentConfig(task_type=task_type),
+    )
+    EMBEDDING_SECONDS.observe(time.perf_counter() - started, task=task_type)
+    return [e.values for e in response.embeddings]
+
+@retry.Retry(
+    predicate=is_retryable_api_error,
+    on_error=count_retry("embed_content"),
 )
+def embed_texts(texts, task_type):
+    """embed_texts_once con reintentos en 429/503, para las consultas."""
+    return embed_texts_once(texts, task_type)
+
+class GeminiEmbeddingFunction:
+    """Función de embeddings para Chroma con una tarea fija e inmutable.
+    Cumple el protocolo chromadb.EmbeddingFunction (`__call__(input)`) sin importar chromadb."""
+
+    def __init__(self, task_type):
+        self.task_type = task_type
+
+    def __call__(self, input):
+        return embed_texts(input, self.task_type)
+
+document_embed_fn = GeminiEmbeddingFunction("retrieval_document")
+def create_chroma_client():
+    # chromadb tarda ~0.4 s en importarse: solo lo carga el hilo del índice
+    import chromadb
+    return chromadb.PersistentClient(path=CHROMA_PATH)
+
+# Índice persistente en disco: sobrevive reinicios y se comparte entre workers del mismo host
+chroma_client = LazyResource("chroma", create_chroma_client)
 
 # Documentos curriculares (ejemplo resumido)
 # documents = [
@@ -83,26 +680,318 @@ knowledge_db = chroma_client.get_or_create_collection(
 # knowledge_db.add(documents=documents, ids=[str(i) for i in range(len(documents))])
 
 TXT_URL = "https://raw.githubusercontent.com/angelmc-12/myfirstrepo/master/curriculo_texto.txt"
+# Copia local del currículo (benchmarks, entornos sin red); si está definida no se descarga
+CURRICULUM_PATH = os.getenv("CURRICULUM_PATH")
+
+def fragment_id(doc):
+    """ID estable de un fragmento: hash de su texto y del modelo de embeddings.
+    Si cambia el texto o el modelo, cambia el ID y el fragmento se vuelve a embeber."""
+    digest = hashlib.sha256(f"{EMBEDDING_MODEL}\n{doc}".encode("utf-8")).hexdigest()
+    return f"frag_{digest[:32]}"
+
+def fetch_curriculum():
+    """Descarga el currículo y lo separa en fragmentos (párrafos de más de 50 caracteres)."""
+    if CURRICULUM_PATH:
+        with open(CURRICULUM_PATH, encoding="utf-8") as f:
+            text = f.read()
+    else:
+        response = requests.get(TXT_URL, timeout=30)
+        response.raise_for_status()
+        text = response.text
 
-response = requests.get(TXT_URL, timeout=30)
-response.raise_for_status()
+    chunks = re.split(r'\n{2,}', text)  # separa por párrafos
+    # dict.fromkeys elimina fragmentos repetidos (mismo ID) conservando el orden
+    return list(dict.fromkeys(chunk.strip() for chunk in chunks if len(chunk.strip()) > 50))
 
-text = response.text
-chunks = re.split(r'\n{2,}', text)  # separa por párrafos
-docs = [chunk.strip() for chunk in chunks if len(chunk.strip()) > 50]
+# ========================
+# Búsqueda por palabras clave (BM25)
+# ========================
+SPANISH_STOPWORDS = frozenset("""
+a al ante bajo como con contra de del desde donde durante e el ella ellos en entre es esta este
+esto estos estas hacia hasta la las le les lo los mas mediante o para pero por que se segun sin
+sobre su sus tambien u un una unas uno unos y ya
+""".split())
 
+def strip_accents(text):
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+def tokenize(text):
+    """Términos en minúsculas y sin tildes; conserva números (grados, ciclos)."""
+    return [
+        token for token in re.findall(r"\w+", strip_accents(text.lower()))
+        if token not in SPANISH_STOPWORDS and (len(token) > 1 or token.isdigit())
+    ]
+
+class BM25Index:
+    """Índice invertido BM25 en memoria sobre los fragmentos curriculares.
+    Capta coincidencias exactas de términos (nombres de competencias, ciclos) que la
+    similitud de embeddings a veces deja por debajo de párrafos solo parecidos."""
+
+    def __init__(self, docs, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # término -> [(índice del fragmento, frecuencia)]
+        self.doc_len = []
+        for i, doc in enumerate(docs):
+            tokens = tokenize(doc)
+            self.doc_len.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                self.postings.setdefault(term, []).append((i, tf))
+        n_docs = len(docs)
+        self.avgdl = (sum(self.doc_len) / n_docs) if n_docs else 1.0
+        self.idf = {
+            term: math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+        self.max_idf = max(self.idf.values(), default=0.0)
+
+    def search(self, query, n_results=5):
+        """Devuelve ([(índice, puntaje)], cobertura). La cobertura es la fracción del peso
+        IDF de la consulta presente en el mejor fragmento (0 a 1): mide qué tan fuerte es
+        la coincidencia por palabras clave."""
+        terms = set(tokenize(query))
+        if not terms:
+            return [], 0.0
+        scores = {}
+        for term in terms:
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for i, tf in self.postings[term]:
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_len[i] / self.avgdl)
+                scores[i] = scores.get(i, 0.0) + idf * tf * (self.k1 + 1) / norm
+        ranked = heapq.nlargest(n_results, scores.items(), key=lambda item: item[1])
+        if not ranked:
+            return [], 0.0
+        best = ranked[0][0]
+        # los términos que no aparecen en el corpus cuentan con el IDF máximo
+        total = sum(self.idf.get(term, self.max_idf) for term in terms)
+        covered = sum(self.idf[term] for term in terms
+                      if term in self.idf and any(i == best for i, _ in self.postings[term]))
+        return ranked, (covered / total) if total else 0.0
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Combina listas ordenadas de fragmentos: puntaje = suma de 1 / (k + posición)."""
+    scores = {}
+    for ranking in rankings:
+        for position, doc in enumerate(ranking, 1):
+            scores[doc] = scores.get(doc, 0.0) + 1.0 / (k + position)
+    return sorted(scores, key=scores.get, reverse=True)
+
+# ========================
+# Ingesta del currículo en segundo plano
+# ========================
 MAX_BATCH = 100
-ids = [f"frag_{i}" for i in range(len(docs))]
+# Cuota de la API de embeddings (peticiones por minuto); cada lote es una petición
+EMBED_REQUESTS_PER_MINUTE = float(os.getenv("EMBED_REQUESTS_PER_MINUTE", "100"))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+INGEST_MAX_RETRIES = int(os.getenv("INGEST_MAX_RETRIES", "6"))
+# Espera antes de reintentar una ingesta fallida y, si es > 0, cada cuánto volver a descargar el currículo
+INGEST_RETRY_SECONDS = float(os.getenv("INGEST_RETRY_SECONDS", "60"))
+CURRICULUM_REFRESH_SECONDS = float(os.getenv("CURRICULUM_REFRESH_SECONDS", "0"))
 
-for i in range(0, len(docs), MAX_BATCH):
-    batch_docs = docs[i:i+MAX_BATCH]
-    batch_ids = ids[i:i+MAX_BATCH]
-    try:
-        knowledge_db.add(documents=batch_docs, ids=batch_ids)
-        print(f"✅ Lote {i//MAX_BATCH + 1} cargado ({len(batch_docs)} fragmentos)")
-        time.sleep(1)  # opcional, evita saturar la API
-    except Exception as e:
-        print(f"⚠️ Error en el lote {i//MAX_BATCH + 1}: {e}")
+LEGACY_COLLECTION = "curriculo_secundaria"
+VERSION_PREFIX = "curriculo_v_"
+
+class TokenBucket:
+    """Limitador token bucket thread-safe: `rate_per_minute` tokens, ráfagas de hasta `capacity`."""
+
+    def __init__(self, rate_per_minute, capacity=1):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, float(capacity))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class CurriculumIndex:
+    """Una versión completa e inmutable del índice: colección de Chroma, fragmentos
+    y su índice BM25 (se publican juntos en el swap)."""
+
+    def __init__(self, version, collection, docs):
+        self.version = version
+        self.collection = collection
+        self.docs = docs
+        self.keywords = BM25Index(docs)
+
+class CurriculumIndexer:
+    """Construye el índice curricular en un hilo aparte y lo publica con un swap atómico.
+
+    Cada corpus se indexa en una colección propia (`curriculo_v_<hash>`). Los
+    fragmentos que ya existen en la versión activa copian su embedding; el resto se
+    embebe en lotes concurrentes bajo un token bucket, reintentando con backoff.
+    Solo cuando la colección está completa reemplaza a la activa, así las consultas
+    nunca ven un índice parcial."""
+
+    def __init__(self, chroma_client):
+        self.chroma_client = chroma_client
+        self.active = None
+        self.state = "iniciando"
+        self.error = None
+        self.embedded = 0
+        self.pending = 0
+        self.rate_limiter = TokenBucket(EMBED_REQUESTS_PER_MINUTE, capacity=INGEST_WORKERS)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # --- versión activa ---
+    def load_active(self):
+        """Publica la última versión completa guardada en disco (sin red ni embeddings)."""
+        complete = []
+        for collection in self.chroma_client.list_collections():
+            metadata = collection.metadata or {}
+            if collection.name.startswith(VERSION_PREFIX) and metadata.get("completa"):
+                complete.append((metadata.get("creada", 0), collection.name))
+        if complete:
+            name = max(complete)[1]
+        elif LEGACY_COLLECTION in {c.name for c in self.chroma_client.list_collections()}:
+            name = LEGACY_COLLECTION  # índice de la versión anterior, mismos IDs por hash
+        else:
+            return
+        collection = self.chroma_client.get_collection(name=name, embedding_function=document_embed_fn)
+        docs = collection.get(include=["documents"])["documents"]
+        self._swap(CurriculumIndex(name, collection, docs))
+        print(f"📚 Índice curricular {name} disponible ({len(docs)} fragmentos)")
+
+    def _swap(self, index):
+        with self._lock:
+            previous, self.active = self.active, index
+        return previous
+
+    @property
+    def ready(self):
+        return self.active is not None
+
+    # --- ciclo de ingesta ---
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="curriculum-indexer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        # primero la versión guardada en disco: el worker queda listo sin esperar a la red
+        try:
+            self.load_active()
+        except Exception as e:
+            print(f"⚠️ No se pudo abrir el índice guardado: {e}")
+        while not self._stop.is_set():
+            try:
+                self.rebuild()
+            except Exception as e:
+                self.state = "error"
+                self.error = str(e)
+                print(f"⚠️ Error indexando el currículo, reintento en {INGEST_RETRY_SECONDS:.0f}s: {e}")
+                self._stop.wait(INGEST_RETRY_SECONDS)
+                continue
+            if CURRICULUM_REFRESH_SECONDS <= 0:
+                return
+            self._stop.wait(CURRICULUM_REFRESH_SECONDS)
+
+    def rebuild(self):
+        """Descarga el currículo y, si cambió, construye y publica una nueva versión."""
+        self.state = "descargando"
+        docs = fetch_curriculum()
+        ids = [fragment_id(doc) for doc in docs]
+        version = VERSION_PREFIX + hashlib.sha256("\n".join(ids).encode("utf-8")).hexdigest()[:16]
+        if self.active is not None and self.active.version == version:
+            self.state = "listo"
+            self.error = None
+            return
+
+        self.state = "indexando"
+        collection = self.chroma_client.get_or_create_collection(
+            name=version, embedding_function=document_embed_fn
+        )
+        existing = set(collection.get(include=[])["ids"])  # restos de una ingesta interrumpida
+        missing = [(doc_id, doc) for doc_id, doc in zip(ids, docs) if doc_id not in existing]
+        missing = self._copy_from_active(collection, missing)
+        self.embedded = 0
+        self.pending = len(missing)
+        print(f"📚 Índice {version}: {len(docs) - len(missing)} fragmentos reutilizados, {len(missing)} por embeber")
+
+        batches = [missing[i:i+MAX_BATCH] for i in range(0, len(missing), MAX_BATCH)]
+        with ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest") as pool:
+            for future in as_completed([pool.submit(self._embed_batch, collection, batch) for batch in batches]):
+                future.result()  # propaga el error si un lote agotó sus reintentos
+
+        collection.modify(metadata={"completa": True, "creada": time.time(), "fragmentos": len(docs)})
+        previous = self._swap(CurriculumIndex(version, collection, docs))
+        self.state = "listo"
+        self.error = None
+        print(f"✅ Índice curricular {version} publicado ({len(docs)} fragmentos)")
+        self._prune(keep={version, previous.version if previous else None})
+
+    def _copy_from_active(self, collection, missing):
+        """Copia los embeddings ya calculados en la versión activa; devuelve los que faltan."""
+        active = self.active
+        if active is None or not missing:
+            return missing
+        wanted = [doc_id for doc_id, _ in missing]
+        copied = set()
+        for i in range(0, len(wanted), MAX_BATCH):
+            found = active.collection.get(ids=wanted[i:i+MAX_BATCH], include=["embeddings", "documents"])
+            if found["ids"]:
+                collection.add(ids=found["ids"], embeddings=found["embeddings"], documents=found["documents"])
+                copied.update(found["ids"])
+        return [(doc_id, doc) for doc_id, doc in missing if doc_id not in copied]
+
+    def _embed_batch(self, collection, batch):
+        batch_ids = [doc_id for doc_id, _ in batch]
+        batch_docs = [doc for _, doc in batch]
+        for attempt in range(INGEST_MAX_RETRIES + 1):
+            self.rate_limiter.acquire()
+            try:
+                # sin retry.Retry interno: el token bucket y este backoff son la única política de reintentos
+                embeddings = embed_texts_once(batch_docs, "retrieval_document")
+                collection.add(ids=batch_ids, embeddings=embeddings, documents=batch_docs)
+                break
+            except Exception as e:
+                if attempt == INGEST_MAX_RETRIES or self._stop.is_set():
+                    raise
+                delay = min(60.0, 2.0 ** attempt) * random.uniform(0.5, 1.5)
+                API_RETRIES.inc(call="embed_content")
+                print(f"⚠️ Lote de {len(batch)} fragmentos falló ({e}), reintento {attempt + 1} en {delay:.1f}s")
+                time.sleep(delay)
+        with self._lock:
+            self.embedded += len(batch)
+
+    def _prune(self, keep):
+        """Elimina versiones antiguas. Se conserva la anterior por si aún hay consultas en curso."""
+        for collection in self.chroma_client.list_collections():
+            name = collection.name
+            if (name.startswith(VERSION_PREFIX) or name == LEGACY_COLLECTION) and name not in keep:
+                self.chroma_client.delete_collection(name=name)
+                print(f"🧹 Versión del índice {name} eliminada")
+
+    def status(self):
+        active = self.active
+        return {
+            "listo": active is not None,
+            "estado": self.state,
+            "version": active.version if active else None,
+            "fragmentos": len(active.docs) if active else 0,
+            "embebidos": self.embedded,
+            "por_embeber": self.pending,
+            "error": self.error,
+        }
+
+curriculum_indexer = CurriculumIndexer(chroma_client)
 
 # ========================
 # Procesar mensaje docente
@@ -144,236 +1033,809 @@ def parse_teacher_message(message: str):
 # ========================
 
 
+# Instrucciones fijas (rol, esquema JSON, requisitos y recursos adicionales): son iguales
+# en todas las peticiones, se envían como system_instruction o como contenido cacheado.
+SYSTEM_INSTRUCTION = (
+    "Actúa como un **asistente pedagógico experto en Matemática del Currículo Nacional Peruano**. "
+    "Tu tarea es ayudar a un docente de educación secundaria a **preparar su sesión de aprendizaje** de forma completa y contextualizada, "
+    "considerando las competencias, capacidades y enfoques pedagógicos oficiales del MINEDU Perú.\n\n"
+
+    "Genera el entregable en formato JSON **válido**, siguiendo exactamente esta estructura:\n\n"
+    "{\n"
+    '  "datosGenerales": {\n'
+    '    "titulo": "",\n'
+    '    "docente": "",\n'
+    '    "fecha": "",\n'
+    '    "grado": "",\n'
+    '    "seccion": ""\n'
+    '  },\n'
+    '  "tema": "",\n'
+    '  "ciclo": "",\n'
+    '  "contexto": "",\n'
+    '  "horasClase": 2,\n'
+    '  "competenciasSeleccionadas": [],\n'
+    '  "capacidades": [],\n'
+    '  "materialesDisponibles": "",\n'
+    '  "enfoqueTransversal": "",\n'
+    '  "competenciaTransversal": "",\n'
+    '  "competenciaDescripcion": "",\n'
+    '  "criteriosEvaluacion": "",\n'
+    '  "evidenciasAprendizaje": "",\n'
+    '  "propositoSesion": "",\n'
+    '  "secuenciaMetodologica": {\n'
+    '    "inicio": "",\n'
+    '    "desarrollo": "",\n'
+    '    "cierre": ""\n'
+    '  },\n'
+    '  "distribucionHoras": "",\n'
+    '  "procesosDidacticos": [],\n'
+    '  "actividadesContextualizadas": [],\n'
+    '  "materialesDidacticosSugeridos": [],\n'
+    '  "recursosAdicionales": {\n'
+    '    "fichasDeTrabajo": [],\n'
+    '    "problemasYEjercicios": [],\n'
+    '    "juegoDidactico": {},\n'
+    '    "actividadDeActivacion": [],\n'
+    '    "evaluacionFormativa": {},\n'
+    '    "comunicadoParaPadres": "",\n'
+    '    "actividadesDiferenciadas": {\n'
+    '      "refuerzo": [],\n'
+    '      "consolidacion": [],\n'
+    '      "profundizacion": []\n'
+    '    }\n'
+    '  }\n'
+    "}\n\n"
+    "Requisitos de la respuesta:\n"
+    "- Usa lenguaje claro y profesional dirigido a docentes peruanos.\n"
+    "- **RESPETA ESTRICTAMENTE la duración especificada** (1 hora pedagógica = 45 minutos).\n"
+    "- Las actividades deben ser **coherentes con el contexto sociocultural y materiales disponibles**.\n"
+    "- Adecúa la dificultad y las estrategias pedagógicas al **grado o ciclo indicado**.\n"
+    "- **CONTEXTUALIZACIÓN OBLIGATORIA**: TODAS las actividades deben relacionarse con el contexto sociocultural indicado:\n"
+    "  * Rural/Agrícola: cultivos, animales, terrenos, cosechas\n"
+    "  * Pesquero: capturas, redes, embarcaciones, mareas\n"
+    "  * Comercial: ventas, precios, descuentos, ganancias\n"
+    "  * Minero: minerales, excavaciones, volúmenes\n"
+    "  * Turístico: rutas, mapas, visitantes, costos\n"
+    "  * Urbano: transporte, edificios, tecnología, servicios\n"
+    "- La distribución del tiempo debe ser realista (Inicio: 15-20%, Desarrollo: 60-70%, Cierre: 10-15%).\n"
+    "- **Secuencia Metodológica Detallada**:\n"
+    "  * INICIO: motivación contextualizada, problematización, saberes previos, propósito (mínimo 3 párrafos)\n"
+    "  * DESARROLLO: situación problemática + 5 procesos didácticos de Matemática + trabajo variado (mínimo 5 párrafos)\n"
+    "  * CIERRE: metacognición, transferencia, evaluación formativa (mínimo 2 párrafos)\n"
+    "- **Procesos Didácticos de Matemática** (siempre en este orden):\n"
+    "  1. Familiarización con el problema\n"
+    "  2. Búsqueda y ejecución de estrategias\n"
+    "  3. Socialización de representaciones\n"
+    "  4. Reflexión y formalización\n"
+    "  5. Planteamiento de otros problemas\n"
+    "- **Criterios de Evaluación**: Deben ser observables, medibles y específicos para esta sesión.\n"
+    "- **Evidencias de Aprendizaje**: Productos concretos que generarán los estudiantes.\n"
+    "- **Propósito de la Sesión**: Claro, alcanzable y redactado en términos de lo que aprenderán.\n"
+    "- **Integrar Enfoques Transversales**: Incluir naturalmente el enfoque transversal en las actividades.\n"
+    "- **Integrar Competencia Transversal**: Si es TICs, sugerir tecnología; si es Aprendizaje Autónomo, incluir autoevaluación.\n"
+    "- Actividades progresivas en dificultad, factibles con los materiales disponibles.\n"
+    "- No devuelvas texto adicional fuera del JSON.\n\n"
+    
+    "**RECURSOS ADICIONALES A INCLUIR:**\n"
+    "1. **fichasDeTrabajo**: Genera 2-3 fichas de trabajo con ejercicios progresivos (básico, intermedio, avanzado) relacionados al tema. "
+    "Cada ficha debe tener título, instrucciones claras y ejercicios específicos.\n\n"
+    
+    "2. **problemasYEjercicios**: Crea 5-8 problemas o ejercicios variados sobre el tema, incluyendo:\n"
+    "   - Problemas básicos de comprensión\n"
+    "   - Ejercicios de aplicación intermedia\n"
+    "   - Desafíos avanzados para estudiantes que necesitan mayor reto\n"
+    "   - Incluye las respuestas correctas y criterios de evaluación\n\n"
+    
+    "3. **juegoDidactico**: Diseña un juego educativo de 15-20 minutos que:\n"
+    "   - Use materiales simples disponibles en el aula (papel, plumones, dados, etc.)\n"
+    "   - Tenga instrucciones paso a paso\n"
+    "   - Incluya 3 niveles de dificultad\n"
+    "   - Fomente el trabajo colaborativo\n"
+    "   - Termine con reflexión grupal\n\n"
+    
+    "4. **actividadDeActivacion**: Proporciona 2-3 actividades de activación de saberes previos de 3-5 minutos para iniciar la clase. "
+    "Deben ser dinámicas y ayudar a conectar con conocimientos anteriores.\n\n"
+    
+    "5. **evaluacionFormativa**: Crea una evaluación formativa de 20-30 minutos que incluya:\n"
+    "   - 5-6 preguntas variadas (básicas, intermedias y avanzadas)\n"
+    "   - Respuestas correctas\n"
+    "   - Criterios de evaluación claros\n"
+    "   - Alineada con las competencias del CNEB\n\n"
+    
+    "6. **comunicadoParaPadres**: Elabora un breve mensaje (200-300 palabras) para padres de familia que:\n"
+    "   - Explique qué están aprendiendo sus hijos\n"
+    "   - Proporcione 2-3 estrategias sencillas para apoyar en casa\n"
+    "   - Use lenguaje cálido y motivador\n"
+    "   - Sea apropiado para enviar por WhatsApp (incluye emojis)\n\n"
+    
+    "7. **actividadesDiferenciadas**: Proporciona rutas de trabajo diferenciadas:\n"
+    "   - **refuerzo**: 2-3 actividades para estudiantes que necesitan consolidar conceptos básicos\n"
+    "   - **consolidacion**: 2-3 actividades para estudiantes en proceso de aprendizaje\n"
+    "   - **profundizacion**: 2-3 actividades desafiantes para estudiantes que ya dominan el tema\n\n"
+)
+
+# Datos del docente: plantilla precompilada, se completa con str.format en cada petición
+TEACHER_DATA_TEMPLATE = (
+    "**DATOS GENERALES:**\n"
+    "- Título: {titulo}\n"
+    "- Docente: {docente}\n"
+    "- Fecha: {fecha}\n"
+    "- Grado: {grado}\n"
+    "- Sección: {seccion}\n\n"
+    
+    "**COMPETENCIAS Y CAPACIDADES:**\n"
+    "- Competencias: {competencias}\n"
+    "- Capacidades: {capacidades}\n\n"
+    
+    "**CONTEXTO:**\n"
+    "- Ciclo: {ciclo}\n"
+    "- Contexto sociocultural: {contexto}\n"
+    "- Duración: {duracion} (1 hora = 45 minutos)\n\n"
+    
+    "**ENFOQUES:**\n"
+    "- Enfoque Transversal: {enfoque_transversal}\n"
+    "- Competencia Transversal: {competencia_transversal}\n\n"
+    
+    "**RECURSOS:**\n"
+    "- Materiales disponibles: {materiales}\n\n"
+    
+    "**IMPORTANTE - RESPETA LA DURACIÓN ESPECIFICADA:**\n"
+    "El docente ha indicado que la sesión debe durar exactamente: {duracion}\n"
+    "- Cada hora pedagógica = 45 minutos.\n"
+    "- Ajusta TODAS las actividades, tiempos y secuencias metodológicas a esta duración específica.\n"
+    "- El campo 'horasClase' en el JSON debe reflejar exactamente el número de horas indicado.\n"
+    "- La 'distribucionHoras' debe desglosar minutos específicos: Inicio (15-20%), Desarrollo (60-70%), Cierre (10-15%).\n"
+    "- Si la duración es corta (1 hora = 45 min), prioriza actividades esenciales.\n"
+    "- Si la duración es larga (2-3 horas = 90-135 min), incluye más práctica y profundización.\n"
+    "- NO propongas actividades que excedan el tiempo disponible.\n\n"
+    
+    "**CONTEXTUALIZACIÓN AL ENTORNO {contexto_entorno}:**\n"
+    "- TODAS las situaciones problemáticas, ejemplos y actividades DEBEN estar relacionadas con este contexto.\n"
+    "- Usa vocabulario, elementos y situaciones propias de este entorno sociocultural.\n"
+    "- Las actividades deben ser significativas y pertinentes para estudiantes de este contexto.\n\n"
+)
+
+PROMPT_CLOSING = (
+    "Ahora, genera el JSON completo con la sesión de aprendizaje contextualizada y lista para ser aplicada en el aula."
+)
+
+
+# ========================
+# Esquema de la respuesta (salida JSON restringida)
+# ========================
+def schema_string():
+    return {"type": "STRING"}
+
+def schema_array(items):
+    return {"type": "ARRAY", "items": items}
+
+def schema_object(**properties):
+    """Objeto con todas sus propiedades obligatorias y en el orden declarado."""
+    return {
+        "type": "OBJECT",
+        "properties": properties,
+        "required": list(properties),
+        "property_ordering": list(properties),
+    }
+
+def schema_optional(schema, *names):
+    """Marca propiedades de un objeto como opcionales."""
+    schema["required"] = [name for name in schema["required"] if name not in names]
+    return schema
+
+def schema_strings(*names):
+    return schema_object(**{name: schema_string() for name in names})
+
+# Refleja la estructura pedida en SYSTEM_INSTRUCTION (y la de ejemplo_output.json)
+LESSON_SCHEMA = schema_object(
+    datosGenerales=schema_strings("titulo", "docente", "fecha", "grado", "seccion"),
+    tema=schema_string(),
+    ciclo=schema_string(),
+    contexto=schema_string(),
+    horasClase={"type": "INTEGER"},
+    competenciasSeleccionadas=schema_array(schema_string()),
+    capacidades=schema_array(schema_string()),
+    materialesDisponibles=schema_string(),
+    enfoqueTransversal=schema_string(),
+    competenciaTransversal=schema_string(),
+    competenciaDescripcion=schema_string(),
+    criteriosEvaluacion=schema_string(),
+    evidenciasAprendizaje=schema_string(),
+    propositoSesion=schema_string(),
+    secuenciaMetodologica=schema_strings("inicio", "desarrollo", "cierre"),
+    distribucionHoras=schema_string(),
+    procesosDidacticos=schema_array(schema_string()),
+    actividadesContextualizadas=schema_array(schema_string()),
+    materialesDidacticosSugeridos=schema_array(schema_string()),
+    recursosAdicionales=schema_object(
+        fichasDeTrabajo=schema_array(schema_object(
+            titulo=schema_string(),
+            instrucciones=schema_string(),
+            ejercicios=schema_array(schema_string()),
+        )),
+        problemasYEjercicios=schema_array(schema_strings("nivel", "problema", "respuesta", "criterio")),
+        juegoDidactico=schema_object(
+            titulo=schema_string(),
+            duracion=schema_string(),
+            participantes=schema_string(),
+            materiales=schema_string(),
+            instrucciones=schema_array(schema_string()),
+            niveles=schema_strings("basico", "intermedio", "avanzado"),
+            reflexion=schema_string(),
+        ),
+        actividadDeActivacion=schema_array(schema_strings("titulo", "duracion", "descripcion")),
+        evaluacionFormativa=schema_object(
+            titulo=schema_string(),
+            duracion=schema_string(),
+            instrucciones=schema_string(),
+            preguntas=schema_array(schema_optional(schema_object(
+                tipo=schema_string(),
+                pregunta=schema_string(),
+                opciones=schema_array(schema_string()),  # solo en preguntas de opción múltiple
+                respuesta_correcta=schema_string(),
+                criterio=schema_string(),
+            ), "opciones")),
+            rubrica=schema_string(),
+        ),
+        comunicadoParaPadres=schema_string(),
+        actividadesDiferenciadas=schema_object(**{
+            ruta: schema_array(schema_strings("titulo", "descripcion", "tiempo", "objetivo"))
+            for ruta in ("refuerzo", "consolidacion", "profundizacion")
+        }),
+    ),
+)
+
+def sections_schema(paths, schema=LESSON_SCHEMA):
+    """Subconjunto del esquema con solo las secciones indicadas. Las rutas pueden ser
+    de primer nivel ("tema") o anidadas ("recursosAdicionales.juegoDidactico")."""
+    children = {}
+    for path in paths:
+        head, _, rest = path.partition(".")
+        if rest:
+            children.setdefault(head, []).append(rest)
+        else:
+            children[head] = None
+    return schema_object(**{
+        head: schema["properties"][head] if rest is None else sections_schema(rest, schema["properties"][head])
+        for head, rest in children.items()
+    })
+
+
 def build_prompt(inputs, retrieved_docs):
     """
-    Construye el prompt que se enviará al modelo Gemini.
+    Construye la parte variable del prompt que se enviará al modelo Gemini
+    (las instrucciones fijas van en SYSTEM_INSTRUCTION).
     Toma en cuenta todos los campos del docente y el contenido curricular relevante.
     """
-
-    prompt = (
-        "Actúa como un **asistente pedagógico experto en Matemática del Currículo Nacional Peruano**. "
-        "Tu tarea es ayudar a un docente de educación secundaria a **preparar su sesión de aprendizaje** de forma completa y contextualizada, "
-        "considerando las competencias, capacidades y enfoques pedagógicos oficiales del MINEDU Perú.\n\n"
-
-        "Genera el entregable en formato JSON **válido**, siguiendo exactamente esta estructura:\n\n"
-        "{\n"
-        '  "datosGenerales": {\n'
-        '    "titulo": "",\n'
-        '    "docente": "",\n'
-        '    "fecha": "",\n'
-        '    "grado": "",\n'
-        '    "seccion": ""\n'
-        '  },\n'
-        '  "tema": "",\n'
-        '  "ciclo": "",\n'
-        '  "contexto": "",\n'
-        '  "horasClase": 2,\n'
-        '  "competenciasSeleccionadas": [],\n'
-        '  "capacidades": [],\n'
-        '  "materialesDisponibles": "",\n'
-        '  "enfoqueTransversal": "",\n'
-        '  "competenciaTransversal": "",\n'
-        '  "competenciaDescripcion": "",\n'
-        '  "criteriosEvaluacion": "",\n'
-        '  "evidenciasAprendizaje": "",\n'
-        '  "propositoSesion": "",\n'
-        '  "secuenciaMetodologica": {\n'
-        '    "inicio": "",\n'
-        '    "desarrollo": "",\n'
-        '    "cierre": ""\n'
-        '  },\n'
-        '  "distribucionHoras": "",\n'
-        '  "procesosDidacticos": [],\n'
-        '  "actividadesContextualizadas": [],\n'
-        '  "materialesDidacticosSugeridos": [],\n'
-        '  "recursosAdicionales": {\n'
-        '    "fichasDeTrabajo": [],\n'
-        '    "problemasYEjercicios": [],\n'
-        '    "juegoDidactico": {},\n'
-        '    "actividadDeActivacion": [],\n'
-        '    "evaluacionFormativa": {},\n'
-        '    "comunicadoParaPadres": "",\n'
-        '    "actividadesDiferenciadas": {\n'
-        '      "refuerzo": [],\n'
-        '      "consolidacion": [],\n'
-        '      "profundizacion": []\n'
-        '    }\n'
-        '  }\n'
-        "}\n\n"
-        "Requisitos de la respuesta:\n"
-        "- Usa lenguaje claro y profesional dirigido a docentes peruanos.\n"
-        "- **RESPETA ESTRICTAMENTE la duración especificada** (1 hora pedagógica = 45 minutos).\n"
-        "- Las actividades deben ser **coherentes con el contexto sociocultural y materiales disponibles**.\n"
-        "- Adecúa la dificultad y las estrategias pedagógicas al **grado o ciclo indicado**.\n"
-        "- **CONTEXTUALIZACIÓN OBLIGATORIA**: TODAS las actividades deben relacionarse con el contexto sociocultural indicado:\n"
-        "  * Rural/Agrícola: cultivos, animales, terrenos, cosechas\n"
-        "  * Pesquero: capturas, redes, embarcaciones, mareas\n"
-        "  * Comercial: ventas, precios, descuentos, ganancias\n"
-        "  * Minero: minerales, excavaciones, volúmenes\n"
-        "  * Turístico: rutas, mapas, visitantes, costos\n"
-        "  * Urbano: transporte, edificios, tecnología, servicios\n"
-        "- La distribución del tiempo debe ser realista (Inicio: 15-20%, Desarrollo: 60-70%, Cierre: 10-15%).\n"
-        "- **Secuencia Metodológica Detallada**:\n"
-        "  * INICIO: motivación contextualizada, problematización, saberes previos, propósito (mínimo 3 párrafos)\n"
-        "  * DESARROLLO: situación problemática + 5 procesos didácticos de Matemática + trabajo variado (mínimo 5 párrafos)\n"
-        "  * CIERRE: metacognición, transferencia, evaluación formativa (mínimo 2 párrafos)\n"
-        "- **Procesos Didácticos de Matemática** (siempre en este orden):\n"
-        "  1. Familiarización con el problema\n"
-        "  2. Búsqueda y ejecución de estrategias\n"
-        "  3. Socialización de representaciones\n"
-        "  4. Reflexión y formalización\n"
-        "  5. Planteamiento de otros problemas\n"
-        "- **Criterios de Evaluación**: Deben ser observables, medibles y específicos para esta sesión.\n"
-        "- **Evidencias de Aprendizaje**: Productos concretos que generarán los estudiantes.\n"
-        "- **Propósito de la Sesión**: Claro, alcanzable y redactado en términos de lo que aprenderán.\n"
-        "- **Integrar Enfoques Transversales**: Incluir naturalmente el enfoque transversal en las actividades.\n"
-        "- **Integrar Competencia Transversal**: Si es TICs, sugerir tecnología; si es Aprendizaje Autónomo, incluir autoevaluación.\n"
-        "- Actividades progresivas en dificultad, factibles con los materiales disponibles.\n"
-        "- No devuelvas texto adicional fuera del JSON.\n\n"
-        
-        "**RECURSOS ADICIONALES A INCLUIR:**\n"
-        "1. **fichasDeTrabajo**: Genera 2-3 fichas de trabajo con ejercicios progresivos (básico, intermedio, avanzado) relacionados al tema. "
-        "Cada ficha debe tener título, instrucciones claras y ejercicios específicos.\n\n"
-        
-        "2. **problemasYEjercicios**: Crea 5-8 problemas o ejercicios variados sobre el tema, incluyendo:\n"
-        "   - Problemas básicos de comprensión\n"
-        "   - Ejercicios de aplicación intermedia\n"
-        "   - Desafíos avanzados para estudiantes que necesitan mayor reto\n"
-        "   - Incluye las respuestas correctas y criterios de evaluación\n\n"
-        
-        "3. **juegoDidactico**: Diseña un juego educativo de 15-20 minutos que:\n"
-        "   - Use materiales simples disponibles en el aula (papel, plumones, dados, etc.)\n"
-        "   - Tenga instrucciones paso a paso\n"
-        "   - Incluya 3 niveles de dificultad\n"
-        "   - Fomente el trabajo colaborativo\n"
-        "   - Termine con reflexión grupal\n\n"
-        
-        "4. **actividadDeActivacion**: Proporciona 2-3 actividades de activación de saberes previos de 3-5 minutos para iniciar la clase. "
-        "Deben ser dinámicas y ayudar a conectar con conocimientos anteriores.\n\n"
-        
-        "5. **evaluacionFormativa**: Crea una evaluación formativa de 20-30 minutos que incluya:\n"
-        "   - 5-6 preguntas variadas (básicas, intermedias y avanzadas)\n"
-        "   - Respuestas correctas\n"
-        "   - Criterios de evaluación claros\n"
-        "   - Alineada con las competencias del CNEB\n\n"
-        
-        "6. **comunicadoParaPadres**: Elabora un breve mensaje (200-300 palabras) para padres de familia que:\n"
-        "   - Explique qué están aprendiendo sus hijos\n"
-        "   - Proporcione 2-3 estrategias sencillas para apoyar en casa\n"
-        "   - Use lenguaje cálido y motivador\n"
-        "   - Sea apropiado para enviar por WhatsApp (incluye emojis)\n\n"
-        
-        "7. **actividadesDiferenciadas**: Proporciona rutas de trabajo diferenciadas:\n"
-        "   - **refuerzo**: 2-3 actividades para estudiantes que necesitan consolidar conceptos básicos\n"
-        "   - **consolidacion**: 2-3 actividades para estudiantes en proceso de aprendizaje\n"
-        "   - **profundizacion**: 2-3 actividades desafiantes para estudiantes que ya dominan el tema\n\n"
-    )
-
-    # --- Información proporcionada por el docente ---
-    prompt += (
-        "**DATOS GENERALES:**\n"
-        f"- Título: {inputs['titulo']}\n"
-        f"- Docente: {inputs['docente']}\n"
-        f"- Fecha: {inputs['fecha']}\n"
-        f"- Grado: {inputs['grado']}\n"
-        f"- Sección: {inputs['seccion']}\n\n"
-        
-        "**COMPETENCIAS Y CAPACIDADES:**\n"
-        f"- Competencias: {inputs['competencias']}\n"
-        f"- Capacidades: {inputs['capacidades']}\n\n"
-        
-        "**CONTEXTO:**\n"
-        f"- Ciclo: {inputs['ciclo']}\n"
-        f"- Contexto sociocultural: {inputs['contexto']}\n"
-        f"- Duración: {inputs['duracion']} (1 hora = 45 minutos)\n\n"
-        
-        "**ENFOQUES:**\n"
-        f"- Enfoque Transversal: {inputs['enfoque_transversal']}\n"
-        f"- Competencia Transversal: {inputs['competencia_transversal']}\n\n"
-        
-        "**RECURSOS:**\n"
-        f"- Materiales disponibles: {inputs['materiales']}\n\n"
-        
-        "**IMPORTANTE - RESPETA LA DURACIÓN ESPECIFICADA:**\n"
-        f"El docente ha indicado que la sesión debe durar exactamente: {inputs['duracion']}\n"
-        "- Cada hora pedagógica = 45 minutos.\n"
-        "- Ajusta TODAS las actividades, tiempos y secuencias metodológicas a esta duración específica.\n"
-        "- El campo 'horasClase' en el JSON debe reflejar exactamente el número de horas indicado.\n"
-        "- La 'distribucionHoras' debe desglosar minutos específicos: Inicio (15-20%), Desarrollo (60-70%), Cierre (10-15%).\n"
-        "- Si la duración es corta (1 hora = 45 min), prioriza actividades esenciales.\n"
-        "- Si la duración es larga (2-3 horas = 90-135 min), incluye más práctica y profundización.\n"
-        "- NO propongas actividades que excedan el tiempo disponible.\n\n"
-        
-        f"**CONTEXTUALIZACIÓN AL ENTORNO {inputs['contexto'].upper()}:**\n"
-        "- TODAS las situaciones problemáticas, ejemplos y actividades DEBEN estar relacionadas con este contexto.\n"
-        "- Usa vocabulario, elementos y situaciones propias de este entorno sociocultural.\n"
-        "- Las actividades deben ser significativas y pertinentes para estudiantes de este contexto.\n\n"
-    )
+    parts = [TEACHER_DATA_TEMPLATE.format(**inputs, contexto_entorno=inputs["contexto"].upper())]
 
     # --- Información curricular recuperada ---
     if retrieved_docs:
-        prompt += "Fragmentos relevantes del Currículo Nacional:\n"
-        for i, doc in enumerate(retrieved_docs, 1):
-            prompt += f"{i}. {doc.strip()}\n"
-        prompt += "\n"
+        parts.append("Fragmentos relevantes del Currículo Nacional:\n")
+        parts.extend(f"{i}. {doc.strip()}\n" for i, doc in enumerate(retrieved_docs, 1))
+        parts.append("\n")
 
-    prompt += (
-        "Ahora, genera el JSON completo con la sesión de aprendizaje contextualizada y lista para ser aplicada en el aula."
-    )
+    parts.append(PROMPT_CLOSING)
+    return "".join(parts)
+
+# ========================
+# Caché de contexto (prefijo fijo del prompt)
+# ========================
+# Con GEMINI_CONTEXT_CACHE=1 el prefijo se registra una vez con el context caching de Gemini
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "0") == "1"
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))  # segundos
+
+class PromptPrefixCache:
+    """Entrega la configuración de generación con el prefijo fijo del prompt.
+    Si el context caching está activo, registra SYSTEM_INSTRUCTION una vez por modelo
+    (client.caches.create) y lo renueva antes de que expire; si está desactivado o la
+    API lo rechaza (p. ej. por no alcanzar el mínimo de tokens), usa system_instruction."""
+
+    def __init__(self, system_instruction, enabled, ttl):
+        self.system_instruction = system_instruction
+        self.enabled = enabled
+        self.ttl = ttl
+        self._caches = {}  # modelo -> (nombre del caché, expira)
+        self._lock = threading.Lock()
+
+    def _cached_content(self, model):
+        with self._lock:
+            name, expires_at = self._caches.get(model, (None, 0))
+            if name and time.monotonic() < expires_at:
+                return name
+            from google.genai import types
+            try:
+                cache = client.caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        system_instruction=self.system_instruction,
+                        display_name="eduai-instrucciones",
+                        ttl=f"{self.ttl}s",
+                    ),
+                )
+            except Exception as e:
+                print(f"⚠️ Context caching no disponible para {model}, se usa system_instruction: {e}")
+                self.enabled = False
+                return None
+            # renovar un minuto antes de que Gemini lo elimine
+            self._caches[model] = (cache.name, time.monotonic() + self.ttl - 60)
+            return cache.name
+
+    def config(self, model, response_schema=LESSON_SCHEMA):
+        """GenerateContentConfig para `model` con salida JSON restringida a `response_schema`
+        (bloqueante la primera vez si hay caché)."""
+        from google.genai import types
+        output = {"response_mime_type": "application/json", "response_schema": response_schema}
+        if self.enabled:
+            name = self._cached_content(model)
+            if name:
+                return types.GenerateContentConfig(cached_content=name, **output)
+        return types.GenerateContentConfig(system_instruction=self.system_instruction, **output)
+
+prompt_prefix = PromptPrefixCache(SYSTEM_INSTRUCTION, GEMINI_CONTEXT_CACHE, GEMINI_CONTEXT_CACHE_TTL)
 
-    return prompt
 
+# strict=False acepta saltos de línea sin escapar dentro de los strings
+JSON_DECODER = json.JSONDecoder(strict=False)
+
+def repair_json(text):
+    """Reparación en una sola pasada de un objeto JSON que empieza en text[0].
+    - Ignora lo que sigue al cierre del objeto (code-fences, texto extra).
+    - Escapa caracteres de control dentro de strings y quita comas colgantes.
+    - Si la salida está truncada, conserva todo hasta el último valor completo
+      y cierra los strings, listas y objetos abiertos.
+    """
+    out = []
+    stack = []
+    in_string = False
+    string_is_key = False
+    escape = False
+    expect_key = False
+    safe_len, safe_stack = 0, []  # último punto donde cerrar los contenedores da JSON válido
+    for ch in text:
+        if in_string:
+            if escape:
+                escape = False
+                out.append(ch)
+            elif ch == "\\":
+                escape = True
+                out.append(ch)
+            elif ch == '"':
+                in_string = False
+                out.append(ch)
+                if not string_is_key:
+                    safe_len, safe_stack = len(out), list(stack)
+            elif ch < " ":
+                out.append(json.dumps(ch)[1:-1])
+            else:
+                out.append(ch)
+        elif ch == '"':
+            in_string = True
+            string_is_key = bool(stack) and stack[-1] == "{" and expect_key
+            out.append(ch)
+        elif ch in "{[":
+            stack.append(ch)
+            expect_key = ch == "{"
+            out.append(ch)
+            safe_len, safe_stack = len(out), list(stack)
+        elif ch in "}]":
+            while out and out[-1] in " \t\r\n":
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            if stack:
+                stack.pop()
+            expect_key = False
+            out.append(ch)
+            safe_len, safe_stack = len(out), list(stack)
+            if not stack:
+                return "".join(out)
+        elif ch == ",":
+            safe_len, safe_stack = len(out), list(stack)
+            expect_key = bool(stack) and stack[-1] == "{"
+            out.append(ch)
+        elif ch == ":":
+            expect_key = False
+            out.append(ch)
+        else:
+            out.append(ch)
+
+    # --- salida truncada ---
+    if in_string and not string_is_key and not escape:
+        out.append('"')
+        safe_len, safe_stack = len(out), list(stack)
+    closers = "".join("}" if opener == "{" else "]" for opener in reversed(safe_stack))
+    return "".join(out[:safe_len]).rstrip().rstrip(",") + closers
 
 def clean_model_output(raw: str):
     """Intenta limpiar outputs de modelos que vienen como texto con code-fences
     o texto extra y devuelve (obj, cleaned_string).
-    - Si puede parsear JSON devuelve el objeto y la cadena usada.
+    - Si puede parsear JSON (directamente o tras repair_json) devuelve el objeto y la cadena usada.
     - Si no puede, devuelve (None, cleaned_candidate).
     """
     if not isinstance(raw, str):
         return None, None
 
-    s = raw.strip()
+    # El objeto empieza en el primer '{': descarta code-fences o texto previo
+    start = raw.find("{")
+    if start == -1:
+        return None, raw.strip()
 
-    # Remover code fences como ```json ... ``` o ``` ... ```
-    m = re.match(r"^```(?:json)?\s*([\s\S]*)\s*```$", s, re.IGNORECASE)
-    if m:
-        s = m.group(1).strip()
-
-    # A veces vienen con comillas extra o texto antes/ despues; buscar primer '{' y último '}'
-    first = s.find('{')
-    last = s.rfind('}')
-    if first != -1 and last != -1 and last > first:
-        candidate = s[first:last+1]
-    else:
-        candidate = s
+    # Caso normal: raw_decode se detiene al cerrar el objeto e ignora lo que sigue
+    try:
+        obj, end = JSON_DECODER.raw_decode(raw, start)
+        return obj, raw[start:end]
+    except ValueError:
+        pass
 
-    # Intentar cargar JSON directamente
+    candidate = repair_json(raw[start:])
     try:
-        obj = json.loads(candidate)
+        obj = JSON_DECODER.decode(candidate)
+        JSON_REPAIRS.inc()
         return obj, candidate
-    except Exception:
-        # Intentar otras limpiezas comunes
-        candidate2 = candidate.strip().strip('"')
-        candidate2 = candidate2.replace('\n', '\\n')
+    except ValueError:
+        # No se pudo parsear
+        return None, candidate
+
+GENERATION_MODEL = "gemini-2.0-flash"
+
+# ========================
+# Despacho de generaciones (plazos, reintentos, hedging y circuit breaker)
+# ========================
+# Modelo alternativo: recibe el hedging y las llamadas cuando el circuito del principal está abierto
+GENERATION_FALLBACK_MODEL = os.getenv("GENERATION_FALLBACK_MODEL", "")
+GENERATION_DEADLINE = float(os.getenv("GENERATION_DEADLINE", "120"))  # segundos por llamada, reintentos incluidos
+GENERATION_MAX_RETRIES = int(os.getenv("GENERATION_MAX_RETRIES", "3"))
+GENERATION_BACKOFF_MAX = float(os.getenv("GENERATION_BACKOFF_MAX", "16"))  # segundos
+# Con GENERATION_HEDGE=1, si la respuesta (o el primer trozo del stream) tarda más que el
+# cuantil GENERATION_HEDGE_QUANTILE de las últimas llamadas, se lanza una segunda y gana la primera
+GENERATION_HEDGE = os.getenv("GENERATION_HEDGE", "0") == "1"
+GENERATION_HEDGE_QUANTILE = float(os.getenv("GENERATION_HEDGE_QUANTILE", "0.9"))
+GENERATION_HEDGE_MIN_SAMPLES = int(os.getenv("GENERATION_HEDGE_MIN_SAMPLES", "20"))
+# Fallos seguidos que abren el circuito de un modelo y segundos hasta dejar pasar una prueba
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", "30"))
+
+class GenerationUnavailable(Exception):
+    """Ningún modelo pudo generar: circuitos abiertos, reintentos agotados o plazo vencido."""
+
+def is_transient_generation_error(e):
+    """Fallos que hablan de la salud del modelo (cuota, sobrecarga, 5xx, red, plazo), no del pedido."""
+    if isinstance(e, TimeoutError) or is_retryable_api_error(e):
+        return True
+    import httpx
+    from google.genai import errors
+    return (isinstance(e, errors.APIError) and (e.code or 0) >= 500) or isinstance(e, httpx.TransportError)
+
+class LatencyBudget:
+    """Latencias recientes por (modelo, tipo de llamada). budget() devuelve el cuantil
+    configurado, o None mientras no haya muestras suficientes (sin hedging a ciegas)."""
+
+    def __init__(self, quantile, window=200, min_samples=20):
+        self.quantile = quantile
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key, seconds):
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def budget(self, key):
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(self.quantile * len(samples)))]
+
+class CircuitBreaker:
+    """Circuito de un modelo: tras `threshold` fallos seguidos se abre `cooldown` segundos
+    (las llamadas van al modelo alternativo) y luego deja pasar una sola prueba."""
+
+    def __init__(self, model, threshold, cooldown):
+        self.model = model
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self._trial and time.monotonic() - self.opened_at >= self.cooldown:
+                self._trial = True  # semiabierto: una llamada de prueba
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def release(self):
+        """Cierra la llamada en curso sin veredicto (cancelada o error del pedido): si era
+        la prueba del circuito semiabierto, la siguiente llamada puede volver a probar."""
+        with self._lock:
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self.opened_at is None and self.failures >= self.threshold):
+                if self.opened_at is None:
+                    print(f"⚠️ Circuito abierto para {self.model} tras {self.failures} fallos seguidos")
+                    CIRCUIT_OPENINGS.inc(model=self.model)
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+    def state(self):
+        if self.opened_at is None:
+            return "cerrado"
+        return "semiabierto" if self._trial else "abierto"
+
+class GenerationDispatcher:
+    """Enruta las llamadas a generate_content / generate_content_stream.
+
+    Cada llamada tiene un plazo total (reintentos incluidos) que también se pasa a la
+    API como timeout. Los 429/503 se reintentan con backoff exponencial y jitter. Con
+    hedging, si la primera llamada no respondió (o no entregó su primer trozo) dentro del
+    p90 observado, se lanza otra contra el modelo alternativo y se usa la que termine
+    primero. Cada modelo tiene su circuit breaker; con el principal abierto se usa el
+    alternativo. Funciona con los dos clientes: generate() usa client.models y hace el
+    hedging con hilos; generate_async() y stream_async() usan client.aio y tareas."""
+
+    def __init__(self, primary, fallback="", deadline=GENERATION_DEADLINE, max_retries=GENERATION_MAX_RETRIES,
+                 hedge=GENERATION_HEDGE, budget=None):
+        self.models = [model for model in dict.fromkeys((primary, fallback)) if model]
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.latency = budget or LatencyBudget(GENERATION_HEDGE_QUANTILE, min_samples=GENERATION_HEDGE_MIN_SAMPLES)
+        self.breakers = {
+            model: CircuitBreaker(model, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_COOLDOWN) for model in self.models
+        }
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    # --- enrutamiento ---
+    def _pick(self, exclude=None):
+        for model in self.models:
+            if model != exclude and self.breakers[model].allow():
+                return model
+        return None
+
+    def _require_model(self):
+        model = self._pick()
+        if model is None:
+            raise GenerationUnavailable("Circuito abierto para todos los modelos de generación")
+        return model
+
+    def _hedge_model(self, model):
+        """Modelo para la segunda llamada, o None si ningún circuito la deja pasar.
+        Sin alternativo disponible va al mismo modelo, también a través de su breaker
+        (con el circuito semiabierto la única llamada permitida ya es la de prueba)."""
+        alternate = self._pick(exclude=model)
+        if alternate is None and self.breakers[model].allow():
+            alternate = model
+        return alternate
+
+    def _config(self, model, response_schema, timeout):
+        from google.genai import types
+        config = prompt_prefix.config(model, response_schema=response_schema)
+        return config.model_copy(update={"http_options": types.HttpOptions(timeout=int(timeout * 1000))})
+
+    def _succeeded(self, model, kind, started):
+        self.breakers[model].success()
+        self.latency.observe((model, kind), time.perf_counter() - started)
+        GENERATION_CALLS.inc(model=model, outcome="ok")
+
+    def _failed(self, model, error):
+        if is_transient_generation_error(error):
+            self.breakers[model].failure()
+        else:
+            self.breakers[model].release()
+        if isinstance(error, asyncio.CancelledError):
+            outcome = "cancelled"  # perdedora del hedging o cliente desconectado
+        else:
+            outcome = "timeout" if isinstance(error, TimeoutError) else "error"
+        GENERATION_CALLS.inc(model=model, outcome=outcome)
+
+    def _retry_delay(self, attempt, error, deadline):
+        """Espera antes del siguiente intento, o el error que corresponde propagar."""
+        if isinstance(error, GenerationUnavailable):
+            raise error
+        if isinstance(error, TimeoutError):
+            raise GenerationUnavailable(f"Gemini no respondió dentro del plazo de {self.deadline:g}s") from error
+        if not is_retryable_api_error(error):
+            raise error
+        delay = min(GENERATION_BACKOFF_MAX, 2.0 ** attempt) * random.uniform(0.5, 1.5)
+        if attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+            raise GenerationUnavailable(f"Gemini no disponible tras {attempt + 1} intentos: {error}") from error
+        API_RETRIES.inc(call="generate_content")
+        return delay
+
+    @staticmethod
+    def _remaining(deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError()
+        return remaining
+
+    # --- cliente síncrono ---
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=2 * MAX_CONCURRENT_GENERATIONS, thread_name_prefix="hedge")
+            return self._pool
+
+    def _call(self, model, contents, response_schema, kind, deadline):
+        started = time.perf_counter()
         try:
-            obj = json.loads(candidate2)
-            return obj, candidate2
-        except Exception:
-            # No se pudo parsear
-            return None, candidate
+            response = client.models.generate_content(
+                model=model,
+                contents=contents,
+                config=self._config(model, response_schema, self._remaining(deadline)),
+            )
+        except BaseException as e:
+            self._failed(model, e)
+            raise
+        self._succeeded(model, kind, started)
+        return response
 
-def generate_lesson(session_id, message):
-    """
-    Genera una sesión de aprendizaje considerando todos los campos del mensaje docente.
-    Usa el tema, competencia, grado/ciclo, contexto, duración y materiales
-    para recuperar fragmentos relevantes del currículo y construir un prompt completo.
-    """
+    def _hedged(self, call, model, kind, deadline):
+        budget = self.latency.budget((model, kind))
+        if budget is None:
+            return call(model)
+        pool = self._executor()
+        futures = [pool.submit(call, model)]
+        done, _ = wait(futures, timeout=min(budget, self._remaining(deadline)))
+        alternate = None if done else self._hedge_model(model)
+        if alternate is not None:
+            HEDGED_REQUESTS.inc(model=alternate)
+            futures.append(pool.submit(call, alternate))
+        error = None
+        try:
+            for future in as_completed(futures, timeout=self._remaining(deadline)):
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e  # la otra llamada todavía puede responder
+        except TimeoutError as e:
+            error = e
+        raise error
 
-    # --- Extraer los datos del mensaje ---
-    inputs = parse_teacher_message(message)
+    def generate(self, contents, response_schema=LESSON_SCHEMA, kind="lesson"):
+        """generate_content con plazo, reintentos, hedging y circuit breaker (cliente síncrono)."""
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(self.max_retries + 1):
+            model = self._require_model()
+            call = lambda m: self._call(m, contents, response_schema, kind, deadline)
+            try:
+                return self._hedged(call, model, kind, deadline) if self.hedge else call(model)
+            except Exception as e:
+                time.sleep(self._retry_delay(attempt, e, deadline))
 
-    # --- Construir texto de búsqueda (usando todos los campos disponibles) ---
+    async def generate_in_thread(self, contents, response_schema=LESSON_SCHEMA, kind="lesson"):
+        """generate() desde un event loop sin bloquearlo: lo usa generate_lesson, que no puede
+        compartir client.aio entre event loops sucesivos."""
+        return await asyncio.to_thread(self.generate, contents, response_schema, kind)
+
+    # --- cliente asíncrono ---
+    async def _call_async(self, model, contents, response_schema, kind, deadline):
+        started = time.perf_counter()
+        try:
+            config = await asyncio.to_thread(self._config, model, response_schema, self._remaining(deadline))
+            response = await asyncio.wait_for(
+                client.aio.models.generate_content(model=model, contents=contents, config=config),
+                self._remaining(deadline),
+            )
+        except BaseException as e:
+            self._failed(model, e)
+            raise
+        self._succeeded(model, kind, started)
+        return response
+
+    async def _hedged_async(self, call, model, kind, deadline):
+        budget = self.latency.budget((model, kind))
+        if budget is None:
+            return await call(model)
+        tasks = {asyncio.ensure_future(call(model))}
+        error = None
+        try:
+            # también la espera del presupuesto queda dentro del try: si cancelan a quien
+            # llama, ninguna llamada a Gemini sigue corriendo huérfana
+            done, _ = await asyncio.wait(tasks, timeout=min(budget, self._remaining(deadline)))
+            alternate = None if done else self._hedge_model(model)
+            if alternate is not None:
+                HEDGED_REQUESTS.inc(model=alternate)
+                tasks.add(asyncio.ensure_future(call(alternate)))
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()  # la llamada más lenta ya no hace falta
+        raise error
+
+    async def generate_async(self, contents, response_schema=LESSON_SCHEMA, kind="lesson"):
+        """Versión asíncrona de generate."""
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(self.max_retries + 1):
+            model = self._require_model()
+            call = lambda m: self._call_async(m, contents, response_schema, kind, deadline)
+            try:
+                if self.hedge:
+                    return await self._hedged_async(call, model, kind, deadline)
+                return await call(model)
+            except Exception as e:
+                await asyncio.sleep(self._retry_delay(attempt, e, deadline))
+
+    async def _open_stream(self, model, contents, response_schema, deadline):
+        """Abre el stream y espera su primer trozo; el hedging de streams se decide aquí."""
+        started = time.perf_counter()
+
+        async def first_chunk(config):
+            stream = await client.aio.models.generate_content_stream(model=model, contents=contents, config=config)
+            return model, await anext(stream, None), stream
+
+        try:
+            config = await asyncio.to_thread(self._config, model, response_schema, self._remaining(deadline))
+            opened = await asyncio.wait_for(first_chunk(config), self._remaining(deadline))
+        except BaseException as e:
+            self._failed(model, e)
+            raise
+        self._succeeded(model, "first_token", started)
+        return opened
+
+    async def _rest_of_stream(self, model, chunk, stream, deadline):
+        try:
+            while chunk is not None:
+                yield chunk
+                chunk = await asyncio.wait_for(anext(stream, None), self._remaining(deadline))
+        except Exception as e:
+            self._failed(model, e)
+            if isinstance(e, TimeoutError):
+                raise GenerationUnavailable(f"Gemini no terminó dentro del plazo de {self.deadline:g}s") from e
+            raise
+
+    async def stream_async(self, contents, response_schema=LESSON_SCHEMA):
+        """generate_content_stream con plazo, reintentos y hedging hasta el primer trozo.
+        Devuelve un iterador asíncrono de trozos, como el del SDK."""
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(self.max_retries + 1):
+            model = self._require_model()
+            call = lambda m: self._open_stream(m, contents, response_schema, deadline)
+            try:
+                if self.hedge:
+                    opened = await self._hedged_async(call, model, "first_token", deadline)
+                else:
+                    opened = await call(model)
+                return self._rest_of_stream(*opened, deadline)
+            except Exception as e:
+                await asyncio.sleep(self._retry_delay(attempt, e, deadline))
+
+    def status(self):
+        return {
+            model: {
+                "circuito": breaker.state(),
+                "fallos_seguidos": breaker.failures,
+                "presupuesto_hedge": self.latency.budget((model, "lesson")),
+            }
+            for model, breaker in self.breakers.items()
+        }
+
+generation_dispatcher = GenerationDispatcher(GENERATION_MODEL, GENERATION_FALLBACK_MODEL)
+
+def build_query_text(inputs):
+    """Texto de búsqueda para el currículo (usando todos los campos disponibles)."""
     query_parts = [
         inputs.get("titulo", ""),
         inputs.get("competencias", ""),
@@ -383,51 +1845,1034 @@ def generate_lesson(session_id, message):
         inputs.get("contexto", ""),
         inputs.get("materiales", "")
     ]
-    query_text = " ".join(part for part in query_parts if part).strip()
+    return " ".join(part for part in query_parts if part).strip()
 
-    # --- Buscar fragmentos relevantes en ChromaDB ---
-    embed_fn.document_mode = False
-    result = knowledge_db.query(query_texts=[query_text], n_results=5)
-    retrieved_docs = result["documents"][0] if result["documents"] else []
+# ========================
+# Embeddings de consultas: caché LRU + micro-batching
+# ========================
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "2048"))
+# Ventana (segundos) para agrupar consultas concurrentes en una sola llamada a embed_content
+QUERY_EMBED_BATCH_WINDOW = float(os.getenv("QUERY_EMBED_BATCH_WINDOW", "0.005"))
 
-    # --- Construir el prompt completo para Gemini ---
-    prompt = build_prompt(inputs, retrieved_docs)
+class QueryEmbedder:
+    """Embeddings de consultas con caché LRU por (task_type, texto normalizado).
+    Las peticiones que llegan dentro de la misma ventana de `window` segundos se
+    agrupan en una única llamada a la API; una consulta ya en vuelo no se repite.
+    Se puede llamar desde cualquier hilo."""
 
-    # --- Llamar al modelo de Gemini ---
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=prompt
+    def __init__(self, embed_batch, max_size, window, max_batch=MAX_BATCH):
+        self._embed_batch = embed_batch
+        self.max_size = max_size
+        self.window = window
+        self.max_batch = max_batch
+        self._cache = OrderedDict()
+        self._pending = {}   # clave -> Future, esperando a la próxima llamada
+        self._inflight = {}  # clave -> Future, ya enviada a la API
+        self._timer = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(text.split())
+
+    def embed(self, text, task_type="retrieval_query"):
+        key = (task_type, self.normalize(text))
+        batch = None
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return vector
+            self.misses += 1
+            future = self._inflight.get(key) or self._pending.get(key)
+            if future is None:
+                future = Future()
+                self._pending[key] = future
+                if self.window <= 0 or len(self._pending) >= self.max_batch:
+                    batch = self._take_pending()
+                elif self._timer is None:
+                    self._timer = threading.Timer(self.window, self._flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if batch:
+            self._run(batch)
+        return future.result()
+
+    def _take_pending(self):
+        """Mueve las claves pendientes a en vuelo. Requiere tener el lock."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        self._inflight.update(batch)
+        return batch
+
+    def _flush(self):
+        with self._lock:
+            batch = self._take_pending()
+        if batch:
+            self._run(batch)
+
+    def _run(self, batch):
+        by_task = {}
+        for (task_type, text), future in batch.items():
+            by_task.setdefault(task_type, []).append((text, future))
+        for task_type, items in by_task.items():
+            texts = [text for text, _ in items]
+            try:
+                vectors = self._embed_batch(texts, task_type)
+            except Exception as e:
+                with self._lock:
+                    for text in texts:
+                        self._inflight.pop((task_type, text), None)
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+            with self._lock:
+                self.api_calls += 1
+                for text, vector in zip(texts, vectors):
+                    key = (task_type, text)
+                    self._inflight.pop(key, None)
+                    self._cache[key] = vector
+                    self._cache.move_to_end(key)
+                while len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+            for (_, future), vector in zip(items, vectors):
+                future.set_result(vector)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "api_calls": self.api_calls,
+            }
+
+query_embedder = QueryEmbedder(embed_texts, QUERY_EMBED_CACHE_SIZE, QUERY_EMBED_BATCH_WINDOW)
+
+def embed_query(query_text):
+    """Embedding de la consulta (tarea retrieval_query), cacheado y agrupado."""
+    return query_embedder.embed(query_text, "retrieval_query")
+
+# Cobertura BM25 (0 a 1) a partir de la cual se responde solo con el índice local,
+# sin embeber la consulta; un valor > 1 desactiva el atajo
+BM25_FAST_PATH_COVERAGE = float(os.getenv("BM25_FAST_PATH_COVERAGE", "0.6"))
+
+def retrieve_documents(query_text, query_embedding=None, n_results=5):
+    """Búsqueda híbrida de fragmentos relevantes: BM25 local fusionado (RRF) con la
+    búsqueda vectorial en ChromaDB. Si la coincidencia por palabras clave es fuerte y no
+    hay un embedding ya calculado, responde solo con BM25 y evita la llamada a la API."""
+    index = curriculum_indexer.active
+    if index is None:
+        return []  # el índice aún se está construyendo: se genera sin fragmentos
+
+    keyword_hits, coverage = index.keywords.search(query_text, n_results * 2)
+    keyword_docs = [index.docs[i] for i, _ in keyword_hits]
+    if query_embedding is None and keyword_docs and coverage >= BM25_FAST_PATH_COVERAGE:
+        return keyword_docs[:n_results]
+
+    if query_embedding is None:
+        query_embedding = embed_query(query_text)
+    result = index.collection.query(query_embeddings=[query_embedding], n_results=n_results * 2)
+    vector_docs = result["documents"][0] if result["documents"] else []
+    return reciprocal_rank_fusion([keyword_docs, vector_docs])[:n_results]
+
+LESSON_PARSE_ERROR = "El modelo no devolvió un JSON válido"
+
+def parse_lesson_output(raw_output):
+    """Limpia y valida el JSON devuelto por el modelo; si falla devuelve una estructura de error.
+    Un objeto sin ninguna sección de la sesión (salida cortada en "{", respuesta fuera de
+    tema como {"respuesta": "Lo siento"}) cuenta como fallo: no es una sesión que completar."""
+    parsed, cleaned_candidate = clean_model_output(raw_output)
+    if isinstance(parsed, dict) and any(key in parsed for key in LESSON_SCHEMA["properties"]):
+        return parsed
+    # No se pudo parsear; devolver estructura de error incluyendo candidato limpio
+    PARSE_FAILURES.inc()
+    return {
+        "error": LESSON_PARSE_ERROR,
+        "raw": raw_output,
+        "cleaned_candidate": cleaned_candidate
+    }
+
+SCHEMA_TYPES = {"OBJECT": dict, "ARRAY": list, "STRING": str, "INTEGER": int}
+
+def schema_matches(value, schema):
+    if not isinstance(value, SCHEMA_TYPES[schema["type"]]):
+        return False
+    if schema["type"] == "OBJECT":
+        return all(
+            schema_matches(value[key], sub) if key in value else key not in schema["required"]
+            for key, sub in schema["properties"].items()
+        )
+    if schema["type"] == "ARRAY":
+        return all(schema_matches(item, schema["items"]) for item in value)
+    return True
+
+def invalid_sections(lesson_json):
+    """Rutas de las secciones que faltan o no cumplen el esquema. Dentro de una sección
+    objeto presente (p. ej. recursosAdicionales) se señala solo la subsección afectada.
+    Una salida que parse_lesson_output marcó como error no se completa."""
+    properties = LESSON_SCHEMA["properties"]
+    if "error" in lesson_json:
+        return []
+    invalid = []
+    for key, schema in properties.items():
+        value = lesson_json.get(key)
+        if schema_matches(value, schema):
+            continue
+        if schema["type"] == "OBJECT" and isinstance(value, dict):
+            invalid.extend(
+                f"{key}.{child}" for child, sub in schema["properties"].items()
+                if not schema_matches(value.get(child), sub)
+            )
+        else:
+            invalid.append(key)
+    return invalid
+
+# Secciones cortas que resumen la sesión y dan coherencia a una regeneración parcial
+SUMMARY_SECTIONS = ("datosGenerales", "tema", "horasClase", "propositoSesion", "criteriosEvaluacion")
+
+def lesson_summary(lesson_json, paths):
+    heads = {path.partition(".")[0] for path in paths}
+    return {key: lesson_json[key] for key in SUMMARY_SECTIONS if key in lesson_json and key not in heads}
+
+def build_sections_prompt(inputs, lesson_json, paths):
+    """Prompt corto para regenerar solo `paths`, coherente con lo ya generado."""
+    return (
+        TEACHER_DATA_TEMPLATE.format(**inputs, contexto_entorno=inputs["contexto"].upper())
+        + "La sesión ya fue generada parcialmente:\n"
+        + json.dumps(lesson_summary(lesson_json, paths), ensure_ascii=False)
+        + "\n\nGenera ÚNICAMENTE un JSON con estas secciones, coherentes con lo anterior: "
+        + ", ".join(paths)
+    )
+
+def merge_sections(lesson_json, raw_sections, paths):
+    """Escribe en `lesson_json` las secciones regeneradas. Devuelve False, y cuenta el fallo
+    de parseo, si la salida no trae ninguna de las secciones pedidas."""
+    sections, _ = clean_model_output(raw_sections)
+    merged = 0
+    if isinstance(sections, dict):
+        for path in paths:
+            head, _, child = path.partition(".")
+            value = sections.get(head)
+            if not child:
+                if head in sections:
+                    lesson_json[head] = value
+                    merged += 1
+            elif isinstance(value, dict) and child in value:
+                lesson_json.setdefault(head, {})[child] = value[child]
+                merged += 1
+    if not merged:
+        PARSE_FAILURES.inc()
+    return merged > 0
+
+async def complete_lesson(inputs, lesson_json, trace=None, generate=None):
+    """Regenera solo las secciones faltantes o inválidas en lugar de toda la sesión.
+    Si la regeneración falla se devuelve la sesión parcial: ya parseada vale más que un error.
+    `generate` es la llamada al dispatcher (por defecto generate_async)."""
+    paths = invalid_sections(lesson_json)
+    if not paths:
+        return lesson_json
+    SECTION_REGENERATIONS.inc(len(paths))
+    generate = generate or generation_dispatcher.generate_async
+    try:
+        response = await generate(
+            build_sections_prompt(inputs, lesson_json, paths), response_schema=sections_schema(paths), kind="sections",
+        )
+    except Exception as e:
+        SECTION_REGENERATION_FAILURES.inc(reason="unavailable" if isinstance(e, GenerationUnavailable) else "error")
+        print(f"⚠️ No se pudieron regenerar {', '.join(paths)}; se entrega la sesión parcial: {e}")
+        return lesson_json
+    if trace is not None:
+        trace.record_usage(response)
+    merge_sections(lesson_json, response.text, paths)
+    return lesson_json
+
+def save_lesson(session_id, inputs, raw_output, lesson_json):
+    """Guarda entradas y resultado final; la salida cruda del modelo solo si no se pudo parsear."""
+    history_store.save_lesson(session_id, inputs, raw_output, lesson_json)
+
+# ========================
+# Caché de sesiones generadas
+# ========================
+LESSON_CACHE_SIZE = int(os.getenv("LESSON_CACHE_SIZE", "256"))
+LESSON_CACHE_TTL = float(os.getenv("LESSON_CACHE_TTL", "21600"))  # segundos (6 horas)
+# Similitud coseno mínima para reutilizar una sesión casi idéntica; 0 desactiva la búsqueda semántica
+LESSON_CACHE_SIMILARITY = float(os.getenv("LESSON_CACHE_SIMILARITY", "0"))
+
+# Campos que determinan el contenido pedagógico de la sesión. Los PERSONAL_FIELDS
+# no cambian la sesión: se vuelven a escribir en datosGenerales al servir desde caché.
+CACHE_KEY_FIELDS = (
+    "titulo", "grado", "competencias", "capacidades", "ciclo", "contexto", "duracion",
+    "enfoque_transversal", "competencia_transversal", "materiales",
+)
+# Campos que deben coincidir también en un acierto semántico: los que no forman parte del
+# texto de búsqueda y los que cambian la sesión aunque apenas muevan el embedding
+# ("2º" frente a "3º" Secundaria, otro contexto o ciclo)
+CACHE_GUARD_FIELDS = (
+    "duracion", "enfoque_transversal", "competencia_transversal", "grado", "ciclo", "contexto",
+)
+PERSONAL_FIELDS = ("docente", "fecha", "seccion")
+# En un acierto semántico el título (y la forma de escribir el grado) pueden variar: se escriben los del docente actual
+RESTAMP_FIELDS = PERSONAL_FIELDS + ("titulo", "grado")
+
+def normalize_field(value):
+    """Minúsculas, sin tildes y con espacios colapsados, para comparar entradas del docente."""
+    return " ".join(strip_accents(value or "").lower().split())
+
+def lesson_cache_key(inputs):
+    normalized = [normalize_field(inputs.get(field, "")) for field in CACHE_KEY_FIELDS]
+    return hashlib.sha256(json.dumps(normalized).encode("utf-8")).hexdigest()
+
+def restamp_lesson(lesson_json, inputs):
+    """Copia de una sesión en caché con los datos generales del docente actual."""
+    lesson = copy.deepcopy(lesson_json)
+    datos = lesson.get("datosGenerales")
+    if isinstance(datos, dict):
+        for field in RESTAMP_FIELDS:
+            datos[field] = inputs.get(field, "")
+    return lesson
+
+class LessonCache:
+    """Caché LRU con TTL de sesiones generadas.
+    Acierto exacto por clave normalizada y, opcionalmente, acierto semántico por
+    similitud coseno del embedding de la consulta. Es thread-safe."""
+
+    def __init__(self, max_size, ttl, similarity=0.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity = similarity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self.saved_tokens = 0
+
+    def _evict_expired(self, now):
+        expired = [key for key, entry in self._entries.items() if entry["expires_at"] <= now]
+        for key in expired:
+            del self._entries[key]
+
+    def _hit(self, key, entry):
+        self._entries.move_to_end(key)
+        self.saved_seconds += entry["elapsed"]
+        self.saved_tokens += entry["tokens"]
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires_at"] > time.monotonic():
+                self.hits += 1
+                return self._hit(key, entry)
+            return None
+
+    def get_similar(self, query_embedding, guard):
+        """Busca la entrada más parecida con los mismos campos de guarda."""
+        if not self.similarity or query_embedding is None:
+            return None
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        with self._lock:
+            self._evict_expired(time.monotonic())
+            best_key, best_score = None, self.similarity
+            for key, entry in self._entries.items():
+                if entry["embedding"] is None or entry["guard"] != guard:
+                    continue
+                score = float(np.dot(query, entry["embedding"]))
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                return None
+            self.near_hits += 1
+            return self._hit(best_key, self._entries[best_key])
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def put(self, key, lesson_json, raw_output, elapsed, tokens=0, query_embedding=None, guard=None):
+        embedding = None
+        if query_embedding is not None:
+            embedding = np.asarray(query_embedding, dtype=np.float32)
+            embedding /= np.linalg.norm(embedding) or 1.0
+        with self._lock:
+            self._entries[key] = {
+                "lesson": lesson_json,
+                "raw": raw_output,
+                "elapsed": elapsed,
+                "tokens": tokens,
+                "embedding": embedding,
+                "guard": guard,
+                "expires_at": time.monotonic() + self.ttl,
+            }
+            self._entries.move_to_end(key)
+            self._evict_expired(time.monotonic())
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.near_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_size,
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.near_hits) / lookups, 4) if lookups else 0.0,
+                "saved_seconds": round(self.saved_seconds, 3),
+                "saved_tokens": self.saved_tokens,
+            }
+
+lesson_cache = LessonCache(LESSON_CACHE_SIZE, LESSON_CACHE_TTL, LESSON_CACHE_SIMILARITY)
+
+def cache_guard(inputs):
+    return tuple(normalize_field(inputs.get(field, "")) for field in CACHE_GUARD_FIELDS)
+
+def lookup_cached_lesson(inputs, query_text):
+    """Devuelve (entrada_en_caché | None, query_embedding | None).
+    Solo calcula el embedding de la consulta si la búsqueda semántica está activa;
+    en ese caso se reutiliza después para la recuperación en Chroma."""
+    entry = lesson_cache.get(lesson_cache_key(inputs))
+    if entry is not None:
+        return entry, None
+    query_embedding = None
+    if lesson_cache.similarity:
+        query_embedding = embed_query(query_text)
+        entry = lesson_cache.get_similar(query_embedding, cache_guard(inputs))
+        if entry is not None:
+            return entry, query_embedding
+    lesson_cache.miss()
+    return None, query_embedding
+
+def store_cached_lesson(inputs, lesson_json, raw_output, elapsed, response, query_embedding, retrieved_docs):
+    if "error" in lesson_json or invalid_sections(lesson_json):
+        return  # no cachear salidas inválidas ni parciales: el siguiente intento debe regenerar
+    if not retrieved_docs:
+        return  # generada sin fragmentos del currículo (índice aún no publicado): no reutilizarla
+    usage = getattr(response, "usage_metadata", None)
+    tokens = getattr(usage, "total_token_count", None) or 0
+    lesson_cache.put(
+        lesson_cache_key(inputs), lesson_json, raw_output, elapsed,
+        tokens=tokens, query_embedding=query_embedding, guard=cache_guard(inputs),
     )
 
+# ========================
+# Refinamiento de sesiones (mensajes de seguimiento)
+# ========================
+# Un mensaje sin los campos del formulario ("haz el juego más corto", "cambia el contexto
+# a pesquero") se aplica sobre la última sesión de la conversación: solo se regeneran las
+# secciones afectadas, con un prompt y una salida mucho más cortos que la sesión completa.
+REFINEMENT_ENABLED = os.getenv("REFINEMENT_ENABLED", "1") == "1"
+
+# Palabras (inicio de palabra, sin tildes) que mencionan una sección -> ruta de la sección
+REFINEMENT_KEYWORDS = (
+    (("juego", "ludic", "gamific"), "recursosAdicionales.juegoDidactico"),
+    (("ficha",), "recursosAdicionales.fichasDeTrabajo"),
+    (("problema", "ejercicio"), "recursosAdicionales.problemasYEjercicios"),
+    (("activacion", "dinamica", "motivacion"), "recursosAdicionales.actividadDeActivacion"),
+    (("evaluacion formativa", "pregunta", "examen", "prueba", "rubrica", "quiz"), "recursosAdicionales.evaluacionFormativa"),
+    (("padres", "familia", "comunicado"), "recursosAdicionales.comunicadoParaPadres"),
+    (("diferenciad", "refuerzo", "consolidacion", "profundizacion"), "recursosAdicionales.actividadesDiferenciadas"),
+    (("secuencia", "inicio", "desarrollo", "cierre"), "secuenciaMetodologica"),
+    (("proposito",), "propositoSesion"),
+    (("criterio",), "criteriosEvaluacion"),
+    (("evidencia",), "evidenciasAprendizaje"),
+    (("procesos didacticos", "proceso didactico"), "procesosDidacticos"),
+    (("contextualizad",), "actividadesContextualizadas"),
+    (("material",), "materialesDidacticosSugeridos"),
+    (("distribucion", "horas"), "distribucionHoras"),
+)
+
+# Secciones que se regeneran cuando no se reconoce ninguna: toda la sesión salvo los datos generales
+ALL_SECTIONS = tuple(key for key in LESSON_SCHEMA["properties"] if key != "datosGenerales")
+
+# Campos del docente que se pueden cambiar en un seguimiento ("cambia el contexto a pesquero",
+# "Duración: 90 minutos") -> secciones que dependen de ellos
+REFINEMENT_FIELDS = {
+    "contexto": (r"contexto", (
+        "contexto", "actividadesContextualizadas", "secuenciaMetodologica",
+        "recursosAdicionales.fichasDeTrabajo", "recursosAdicionales.problemasYEjercicios",
+        "recursosAdicionales.juegoDidactico", "recursosAdicionales.actividadDeActivacion",
+    )),
+    "duracion": (r"duraci[oó]n", ("horasClase", "distribucionHoras", "secuenciaMetodologica")),
+    "materiales": (r"materiales", ("materialesDisponibles", "materialesDidacticosSugeridos")),
+    "enfoque_transversal": (r"enfoque transversal", ("enfoqueTransversal",)),
+    "competencia_transversal": (r"competencia transversal", ("competenciaTransversal",)),
+    "titulo": (r"t[ií]tulo|tema", ALL_SECTIONS),
+    "grado": (r"grado", ALL_SECTIONS),
+}
+# Un cambio de campo tiene que ser explícito: "Campo: valor" al inicio de una frase,
+# un verbo de cambio ("cambia/pon/usa el campo a|por|en|: valor") o "que el campo sea valor".
+# Así "el grado al que va dirigido está bien" no se lee como un cambio de grado.
+CHANGE_VERBS = r"cambia|cambiar|cambiale|pon|poner|ponle|usa|usar|utiliza|modifica|ajusta|actualiza|reemplaza"
+FIELD_VALUE = r"\s*(.+?)\s*(?=\s+y\s+|[.;,\n]|$)"
+FIELD_CHANGE_PATTERNS = {
+    field: re.compile(
+        rf"(?:(?:^|[.;,\n]|\by\b)\s*(?:{label})\s*[:=]"
+        rf"|\b(?:{CHANGE_VERBS})\s+(?:(?:el|la|los|las|su)\s+)?(?:{label})\s*(?:[:=]|\b(?:a|al|por|en|como)\b)"
+        rf"|\bque\s+(?:el|la|los|las|su)\s+(?:{label})\s+sea\b){FIELD_VALUE}",
+        re.IGNORECASE,
+    )
+    for field, (label, _) in REFINEMENT_FIELDS.items()
+}
+# "más problemas para el contexto urbano": el contexto también se reconoce por su valor
+CONTEXT_VALUE_PATTERN = re.compile(
+    r"\bcontexto\s+(?:sociocultural\s+)?(rural(?:/agr[ií]cola)?|agr[ií]cola|pesquero|comercial|minero|tur[ií]stico|urbano)\b",
+    re.IGNORECASE,
+)
+
+def is_refinement_message(inputs):
+    """Los mensajes nuevos traen el formulario completo; un seguimiento no trae tema ni competencias."""
+    return REFINEMENT_ENABLED and not inputs["titulo"] and not inputs["competencias"]
+
+def get_last_lesson(session_id):
+    """Entradas y sesión de la última generación válida de la conversación, o (None, None)."""
+    return history_store.get_last_lesson(session_id)
+
+def field_changes(instruction):
+    """Campos del docente que el seguimiento cambia explícitamente: {campo: valor}."""
+    changes = {}
+    for field, pattern in FIELD_CHANGE_PATTERNS.items():
+        match = pattern.search(instruction)
+        if field == "contexto" and not match:
+            match = CONTEXT_VALUE_PATTERN.search(instruction)
+        if match and match.group(1):
+            value = match.group(1).strip()
+            changes[field] = value[:1].upper() + value[1:]
+    return changes
+
+def refinement_paths(instruction, changes):
+    """Secciones que toca el seguimiento. Una sección de primer nivel incluye sus subsecciones."""
+    text = strip_accents(instruction.lower())
+    paths = [
+        path for keywords, path in REFINEMENT_KEYWORDS
+        if any(re.search(r"\b" + re.escape(keyword), text) for keyword in keywords)
+    ]
+    for field in changes:
+        paths.extend(REFINEMENT_FIELDS[field][1])
+    if not paths:
+        paths = list(ALL_SECTIONS)
+    heads = {path for path in paths if "." not in path}
+    return list(dict.fromkeys(
+        path for path in paths if "." not in path or path.partition(".")[0] not in heads
+    ))
+
+def section_value(lesson_json, path):
+    head, _, child = path.partition(".")
+    value = lesson_json.get(head)
+    return value.get(child) if child and isinstance(value, dict) else value
+
+def build_refinement_prompt(inputs, lesson_json, paths, instruction):
+    """Prompt con el resumen de la sesión, el contenido actual de `paths` y el pedido del docente."""
+    current = {path: section_value(lesson_json, path) for path in paths}
+    return (
+        TEACHER_DATA_TEMPLATE.format(**inputs, contexto_entorno=inputs["contexto"].upper())
+        + "La sesión ya fue generada:\n"
+        + json.dumps(lesson_summary(lesson_json, paths), ensure_ascii=False)
+        + "\n\nContenido actual de las secciones a modificar:\n"
+        + json.dumps(current, ensure_ascii=False)
+        + f"\n\nPedido del docente: {instruction.strip()}\n"
+        + "Aplica el pedido y genera ÚNICAMENTE un JSON con estas secciones, coherentes con el resto de la sesión: "
+        + ", ".join(paths)
+    )
+
+def plan_refinement(session_id, message):
+    """Prepara el refinamiento: (entradas actualizadas, sesión previa, rutas), o None si
+    la conversación no tiene una sesión previa que refinar."""
+    previous_inputs, previous_lesson = get_last_lesson(session_id)
+    if previous_lesson is None:
+        return None
+    # un "cambio" al valor que ya tenía la sesión no regenera nada
+    changes = {
+        field: value for field, value in field_changes(message).items()
+        if normalize_field(value) != normalize_field(previous_inputs.get(field))
+    }
+    inputs = {**previous_inputs, **changes}
+    lesson = copy.deepcopy(previous_lesson)
+    datos = lesson.get("datosGenerales")
+    if isinstance(datos, dict):
+        for field in ("titulo", "grado"):
+            if field in changes:
+                datos[field] = changes[field]
+    return inputs, lesson, refinement_paths(message, changes)
+
+REFINEMENT_PARSE_ERROR = "No se pudo aplicar el cambio: el modelo no devolvió un JSON válido, intenta nuevamente"
+
+async def refine_lesson(session_id, message, plan, trace, generate=None):
+    """Regenera solo las secciones afectadas por el seguimiento y las fusiona con la sesión previa."""
+    inputs, lesson_json, paths = plan
+    generate = generate or generation_dispatcher.generate_async
+    trace.refinement = True
+    SECTION_REGENERATIONS.inc(len(paths))
+    with trace.stage("prompt"):
+        prompt = build_refinement_prompt(inputs, lesson_json, paths, message)
+    with trace.stage("generate"):
+        response = await generate(prompt, response_schema=sections_schema(paths), kind="sections")
+    trace.record_usage(response)
     raw_output = response.text
-    # --- Limpiar y validar el JSON devuelto ---
-    parsed, cleaned_candidate = clean_model_output(raw_output)
-    if parsed is not None:
-        lesson_json = parsed
+    with trace.stage("clean"):
+        merged = merge_sections(lesson_json, raw_output, paths)
+    if merged:
+        with trace.stage("complete"):
+            lesson_json = await complete_lesson(inputs, lesson_json, trace, generate)
     else:
-        # Intento fallback: cargar el texto tal cual
+        # Sin secciones que aplicar: la sesión previa sigue siendo la última válida
+        lesson_json = {"error": REFINEMENT_PARSE_ERROR, "raw": raw_output}
+    with trace.stage("persist"):
+        await asyncio.to_thread(save_lesson, session_id, inputs, raw_output, lesson_json)
+    return lesson_json
+
+# ========================
+# Generación en streaming
+# ========================
+class IncrementalSectionParser:
+    """Parser incremental del objeto JSON de nivel superior que devuelve el modelo.
+    Recibe el texto por trozos y entrega cada clave de primer nivel
+    (datosGenerales, secuenciaMetodologica, recursosAdicionales...) en cuanto su
+    valor termina, sin esperar al resto del documento. Ignora code-fences o texto
+    previo al primer '{'."""
+
+    def __init__(self):
+        self._state = "start"  # start | key | colon | value | next | done
+        self._key = []
+        self._value = []
+        self._current_key = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def _finish_value(self, sections):
+        raw = "".join(self._value).strip()
         try:
-            lesson_json = json.loads(raw_output)
-        except Exception:
-            # No se pudo parsear; devolver estructura de error incluyendo candidato limpio
-            lesson_json = {
-                "error": "El modelo no devolvió un JSON válido",
-                "raw": raw_output,
-                "cleaned_candidate": cleaned_candidate
-            }
+            sections.append((self._current_key, json.loads(raw)))
+        except ValueError:
+            pass  # sección inválida: se resolverá con el parseo completo al final
+        self._value = []
+        self._current_key = None
+
+    def feed(self, chunk):
+        """Procesa un trozo de texto y devuelve la lista de (clave, valor) completados."""
+        sections = []
+        for ch in chunk:
+            state = self._state
+            if state == "value":
+                if self._in_string:
+                    self._value.append(ch)
+                    if self._escape:
+                        self._escape = False
+                    elif ch == "\\":
+                        self._escape = True
+                    elif ch == '"':
+                        self._in_string = False
+                elif ch == '"':
+                    self._value.append(ch)
+                    self._in_string = True
+                elif ch in "{[":
+                    self._value.append(ch)
+                    self._depth += 1
+                elif ch in "}]":
+                    if self._depth == 0:
+                        # cierre del objeto principal tras un valor escalar
+                        self._finish_value(sections)
+                        self._state = "done"
+                        continue
+                    self._value.append(ch)
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self._finish_value(sections)
+                        self._state = "next"
+                elif ch == "," and self._depth == 0:
+                    self._finish_value(sections)
+                    self._state = "next"
+                else:
+                    self._value.append(ch)
+            elif state == "key":
+                if self._escape:
+                    self._key.append(ch)
+                    self._escape = False
+                elif ch == "\\":
+                    self._key.append(ch)
+                    self._escape = True
+                elif ch == '"':
+                    self._current_key = json.loads('"' + "".join(self._key) + '"')
+                    self._key = []
+                    self._state = "colon"
+                else:
+                    self._key.append(ch)
+            elif state == "next":
+                if ch == '"':
+                    self._state = "key"
+                elif ch == "}":
+                    self._state = "done"
+            elif state == "colon":
+                if ch == ":":
+                    self._state = "value"
+                    self._depth = 0
+                    self._in_string = False
+                    self._escape = False
+            elif state == "start":
+                if ch == "{":
+                    self._state = "next"
+            else:
+                break
+        return sections
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def section_events(lesson_json, paths):
+    """Eventos `section` de las secciones de primer nivel tocadas por `paths`."""
+    for key in dict.fromkeys(path.partition(".")[0] for path in paths):
+        if key in lesson_json:
+            yield "section", {"key": key, "value": lesson_json[key]}
+
+# ========================
+# Pipeline de generación de sesiones
+# ========================
+async def lesson_steps(session_id, message, trace, streaming=False, retrieve=None, sync_client=False):
+    """
+    Pasos comunes de /webhook, /webhook/stream y /batch: parseo del mensaje,
+    seguimiento sobre la sesión anterior, caché, recuperación, prompt, generación,
+    limpieza, completado de secciones y persistencia.
+    Produce eventos (tipo, datos): `section` con cada clave de primer nivel apenas
+    está lista y un `done` final con la sesión completa (o la estructura de error).
+    Con streaming=True usa generate_content_stream y emite las secciones mientras
+    el modelo escribe; si no, una sola llamada a generate_content. Con sync_client=True
+    las llamadas a Gemini usan el cliente síncrono en un hilo (generate_lesson).
+    """
+    generate = generation_dispatcher.generate_in_thread if sync_client else generation_dispatcher.generate_async
+    # --- Extraer los datos del mensaje ---
+    with trace.stage("parse_input"):
+        inputs = parse_teacher_message(message)
+        query_text = build_query_text(inputs)
+
+    # --- Seguimiento sobre la sesión anterior: solo se regeneran las secciones afectadas ---
+    if is_refinement_message(inputs):
+        with trace.stage("history"):
+            plan = await asyncio.to_thread(plan_refinement, session_id, message)
+        if plan is not None:
+            lesson_json = await refine_lesson(session_id, message, plan, trace, generate)
+            for event in section_events(lesson_json, plan[2]):
+                yield event
+            yield "done", lesson_json
+            return
+
+    # --- Reutilizar una sesión equivalente ya generada ---
+    with trace.stage("cache_lookup"):
+        cached, query_embedding = await asyncio.to_thread(lookup_cached_lesson, inputs, query_text)
+    if cached is not None:
+        trace.cache = "hit"
+        lesson_json = restamp_lesson(cached["lesson"], inputs)
+        for event in section_events(lesson_json, lesson_json.keys()):
+            yield event
+        with trace.stage("persist"):
+            await asyncio.to_thread(save_lesson, session_id, inputs, cached["raw"], lesson_json)
+        yield "done", lesson_json
+        return
+
+    # --- Buscar fragmentos relevantes en ChromaDB ---
+    with trace.stage("retrieval"):
+        if retrieve is None:
+            retrieved_docs = await asyncio.to_thread(retrieve_documents, query_text, query_embedding)
+        else:
+            retrieved_docs = await retrieve(query_text, query_embedding)
+
+    # --- Construir el prompt completo para Gemini ---
+    with trace.stage("prompt"):
+        prompt = build_prompt(inputs, retrieved_docs)
+
+    # --- Llamar al modelo de Gemini ---
+    started = time.perf_counter()
+    if streaming:
+        stream = await generation_dispatcher.stream_async(prompt)
+        section_parser = IncrementalSectionParser()
+        raw_parts = []
+        response = None
+        async for response in stream:
+            if not raw_parts:
+                trace.observe("first_token", time.perf_counter() - started)
+            text = response.text or ""
+            raw_parts.append(text)
+            for key, value in section_parser.feed(text):
+                yield "section", {"key": key, "value": value}
+        trace.observe("generate", time.perf_counter() - started)
+        raw_output = "".join(raw_parts)
+    else:
+        with trace.stage("generate"):
+            response = await generate(prompt)
+        raw_output = response.text
+    # En streaming, el último trozo trae los usage_metadata acumulados
+    trace.record_usage(response)
+
+    with trace.stage("clean"):
+        lesson_json = parse_lesson_output(raw_output)
+    missing = invalid_sections(lesson_json)
+    if missing:
+        with trace.stage("complete"):
+            lesson_json = await complete_lesson(inputs, lesson_json, trace, generate)
+        for event in section_events(lesson_json, missing):
+            yield event
+    store_cached_lesson(
+        inputs, lesson_json, raw_output, time.perf_counter() - started, response, query_embedding, retrieved_docs,
+    )
 
     # --- Guardar historial de conversación ---
-    # Guardar entradas y salidas para debugging: inputs, raw model output y resultado final
-    save_message(session_id, "user", json.dumps(inputs, ensure_ascii=False))
-    save_message(session_id, "bot_raw", raw_output)
-    save_message(session_id, "bot", json.dumps(lesson_json, ensure_ascii=False))
+    with trace.stage("persist"):
+        await asyncio.to_thread(save_lesson, session_id, inputs, raw_output, lesson_json)
+
+    yield "done", lesson_json
+
+async def lesson_pipeline(session_id, message, trace, **options):
+    """lesson_steps cerrando siempre la traza: también si falla o el cliente se desconecta."""
+    lesson_json = error = None
+    try:
+        async with aclosing(lesson_steps(session_id, message, trace, **options)) as steps:
+            async for event, data in steps:
+                if event == "done":
+                    lesson_json = data
+                yield event, data
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        trace.finish(lesson_json, error)
 
+async def generate_lesson_async(session_id, message, retrieve=None, endpoint="webhook", sync_client=False):
+    """
+    Genera una sesión de aprendizaje considerando todos los campos del mensaje docente.
+    La recuperación (Chroma + embedding) y la escritura en SQLite corren en hilos
+    y la llamada a Gemini usa el cliente asíncrono, así el loop nunca se bloquea.
+    `retrieve` permite compartir la recuperación entre varias sesiones (lotes).
+    """
+    trace = RequestTrace(endpoint, session_id)
+    async for _, lesson_json in lesson_pipeline(
+        session_id, message, trace, retrieve=retrieve, sync_client=sync_client,
+    ):
+        pass  # el último evento (`done`) trae la sesión
     return lesson_json
 
+def generate_lesson(session_id, message):
+    """
+    Versión síncrona de generate_lesson_async, para scripts fuera de un event loop.
+    Las llamadas a Gemini van por el cliente síncrono (client.models): client.aio guarda
+    un httpx.AsyncClient atado al primer event loop y fallaría en el siguiente asyncio.run.
+    """
+    return asyncio.run(generate_lesson_async(session_id, message, endpoint="generate_lesson", sync_client=True))
+
+async def generate_lesson_stream(session_id, message):
+    """
+    Igual que generate_lesson_async pero usando generate_content_stream: produce
+    eventos SSE `section` con cada clave de primer nivel apenas se completa y un
+    evento final `done` con la sesión completa (o la estructura de error).
+    """
+    trace = RequestTrace("webhook_stream", session_id)
+    async with aclosing(lesson_pipeline(session_id, message, trace, streaming=True)) as events:
+        async for event, data in events:
+            yield sse_event(event, data)
+
+# ========================
+# Control de concurrencia
+# ========================
+MAX_CONCURRENT_GENERATIONS = int(os.getenv("MAX_CONCURRENT_GENERATIONS", "32"))
+GENERATION_QUEUE_TIMEOUT = float(os.getenv("GENERATION_QUEUE_TIMEOUT", "2"))
+GENERATION_RETRY_AFTER = int(os.getenv("GENERATION_RETRY_AFTER", "10"))
+
+class GenerationLimiter:
+    """Limita las generaciones en curso por worker.
+    Si no se libera un cupo en `queue_timeout` segundos, acquire() devuelve False
+    y el endpoint responde 429 (backpressure) en lugar de acumular peticiones."""
+
+    def __init__(self, limit, queue_timeout):
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def acquire(self, blocking=False):
+        """Reserva un cupo. Con blocking=True espera sin límite (trabajos por lotes)."""
+        try:
+            timeout = None if blocking else self.queue_timeout
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+generation_limiter = GenerationLimiter(MAX_CONCURRENT_GENERATIONS, GENERATION_QUEUE_TIMEOUT)
+
+def unavailable_response(error):
+    return JSONResponse(
+        {"error": f"El servicio de generación no está disponible, intenta nuevamente en unos segundos ⏳ ({error})"},
+        status_code=503,
+        headers={"Retry-After": str(GENERATION_RETRY_AFTER)},
+    )
+
+def busy_response():
+    return JSONResponse(
+        {"error": "El servidor está ocupado generando otras sesiones, intenta nuevamente en unos segundos ⏳"},
+        status_code=429,
+        headers={"Retry-After": str(GENERATION_RETRY_AFTER)},
+    )
+
+# ========================
+# Generación por lotes (unidades completas)
+# ========================
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+BATCH_JOB_TTL = float(os.getenv("BATCH_JOB_TTL", "3600"))  # segundos que se conservan los resultados
+
+class SharedRetrieval:
+    """Recuperación compartida dentro de un lote: cada texto de búsqueda distinto se
+    resuelve una sola vez aunque varias sesiones lo pidan a la vez."""
+
+    def __init__(self):
+        self._tasks = {}
+
+    async def __call__(self, query_text, query_embedding=None):
+        task = self._tasks.get(query_text)
+        if task is None:
+            task = asyncio.ensure_future(asyncio.to_thread(retrieve_documents, query_text, query_embedding))
+            self._tasks[query_text] = task
+        return await task
+
+class BatchJob:
+    """Estado de un lote: resultados por posición, en el orden en que se pidieron."""
+
+    def __init__(self, items):
+        self.id = uuid.uuid4().hex
+        self.items = items
+        self.results = [None] * len(items)
+        self.completed = 0
+        self.status = "en_curso"
+        self.created_at = time.time()
+        self.finished_at = None
+        self.updates = asyncio.Queue()  # resultados para el cliente que hace streaming
+        self.task = None
+
+    def add_result(self, index, session_id, lesson_json):
+        result = {"index": index, "session_id": session_id, "lesson": lesson_json}
+        self.results[index] = result
+        self.completed += 1
+        self.updates.put_nowait(result)
+
+    def finish(self):
+        self.status = "completado"
+        self.finished_at = time.time()
+        self.updates.put_nowait(None)
+
+    def summary(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "total": len(self.items),
+            "completed": self.completed,
+            "elapsed": round((self.finished_at or time.time()) - self.created_at, 3),
+        }
+
+batch_jobs = {}
+
+def create_batch_job(items):
+    now = time.time()
+    for job_id in [job_id for job_id, job in batch_jobs.items() if now - job.created_at > BATCH_JOB_TTL]:
+        del batch_jobs[job_id]
+    job = BatchJob(items)
+    batch_jobs[job.id] = job
+    return job
+
+async def run_batch_job(job):
+    """Genera todas las sesiones del lote en paralelo (hasta BATCH_CONCURRENCY).
+    Las sesiones pedagógicamente idénticas esperan a la primera y salen de la caché."""
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    retrieve = SharedRetrieval()
+    leaders = {}
+
+    async def run_item(index, session_id, message):
+        key = lesson_cache_key(parse_teacher_message(message))
+        leader = leaders[key]
+        if leader is not asyncio.current_task():
+            await asyncio.wait([leader])
+        async with semaphore:
+            await generation_limiter.acquire(blocking=True)
+            try:
+                lesson_json = await generate_lesson_async(session_id, message, retrieve=retrieve, endpoint="batch")
+            except Exception as e:
+                lesson_json = {"error": f"No se pudo generar la sesión: {e}"}
+            finally:
+                generation_limiter.release()
+        job.add_result(index, session_id, lesson_json)
+
+    tasks = []
+    for index, (session_id, message) in enumerate(job.items):
+        task = asyncio.create_task(run_item(index, session_id, message))
+        leaders.setdefault(lesson_cache_key(parse_teacher_message(message)), task)
+        tasks.append(task)
+    await asyncio.gather(*tasks)
+    job.finish()
+
+async def stream_batch_job(job):
+    """NDJSON: una línea de cabecera, una por sesión terminada y un resumen final."""
+    yield json.dumps(job.summary(), ensure_ascii=False) + "\n"
+    while True:
+        result = await job.updates.get()
+        if result is None:
+            break
+        yield json.dumps(result, ensure_ascii=False) + "\n"
+    yield json.dumps(job.summary(), ensure_ascii=False) + "\n"
+
+def parse_batch_items(payload):
+    """Acepta {"session_id": ..., "messages": [texto | {"Body": ..., "From": ...}]}."""
+    default_session = payload.get("session_id") or "default_user"
+    items = []
+    for message in payload.get("messages") or []:
+        if isinstance(message, dict):
+            items.append((message.get("From") or default_session, message.get("Body") or ""))
+        else:
+            items.append((default_session, message if isinstance(message, str) else ""))
+    return items
+
 # ========================
 # API FastAPI (WhatsApp / Frontend)
 # ========================
-app = FastAPI()
+# Con WARM_UP_ON_STARTUP=0 los recursos se construyen recién en la primera petición que los usa
+WARM_UP_ON_STARTUP = os.getenv("WARM_UP_ON_STARTUP", "1") == "1"
+
+def lazy_resources():
+    return [r for r in (client, history_store, chroma_client) if isinstance(r, LazyResource)]
+
+def warm_up():
+    """Construye el cliente de Gemini y el historial en segundo plano, para que la
+    primera petición no pague su costo. Un fallo no tumba el worker: se reintenta en el primer uso."""
+    for resource in (client, history_store):
+        if isinstance(resource, LazyResource):
+            try:
+                resource.get()
+            except Exception as e:
+                print(f"⚠️ No se pudo inicializar {resource.name}: {e}")
+
+@asynccontextmanager
+async def lifespan(app):
+    # Nada bloquea el arranque: el worker abre el puerto de inmediato (/healthz) y
+    # el índice (carga desde disco + ingesta) y los clientes se preparan en segundo plano
+    if WARM_UP_ON_STARTUP:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    curriculum_indexer.start()
+    yield
+    curriculum_indexer.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 # --- CORS Middleware ---
 origins = ["*"]  # Ajusta en producción
@@ -441,7 +2886,32 @@ app.add_middleware(
 
 @app.get("/")
 def home():
-    return {"status": "ok", "message": "Generador de sesiones educativas corriendo 🚀"}
+    return {
+        "status": "ok",
+        "message": "Generador de sesiones educativas corriendo 🚀",
+        "generaciones_en_curso": generation_limiter.in_flight,
+        "max_generaciones": generation_limiter.limit,
+        "indice": curriculum_indexer.status(),
+        "modelos": generation_dispatcher.status(),
+    }
+
+@app.get("/healthz")
+def healthz():
+    """Liveness: el proceso atiende peticiones. No toca recursos externos."""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+def readyz():
+    """Readiness: índice curricular publicado y ningún cliente en error (503 mientras tanto).
+    Un recurso "pendiente" cuenta como listo: con WARM_UP_ON_STARTUP=0 se construye en
+    la primera petición, que el balanceador solo envía si el worker ya está listo."""
+    resources = {r.name: r.status() for r in lazy_resources()}
+    index = curriculum_indexer.status()
+    ready = index["listo"] and not any(status.startswith("error") for status in resources.values())
+    return JSONResponse(
+        {"listo": ready, "recursos": resources, "indice": index},
+        status_code=200 if ready else 503,
+    )
 
 @app.post("/webhook")
 async def webhook(request: Request):
@@ -452,5 +2922,91 @@ async def webhook(request: Request):
     if not user_message:
         return JSONResponse({"error": "Por favor envía: Tema, Competencia, Grado y Contexto 📚"})
 
-    lesson_plan = generate_lesson(session_id, user_message)
+    if not await generation_limiter.acquire():
+        return busy_response()
+    try:
+        lesson_plan = await generate_lesson_async(session_id, user_message)
+    except GenerationUnavailable as e:
+        return unavailable_response(e)
+    finally:
+        generation_limiter.release()
     return JSONResponse(lesson_plan)
+
+@app.post("/webhook/stream")
+async def webhook_stream(request: Request):
+    """Como /webhook pero responde con Server-Sent Events: una sección por evento."""
+    form = await request.form()
+    user_message = form.get("Body", "")
+    session_id = form.get("From", "default_user")
+
+    if not user_message:
+        return JSONResponse({"error": "Por favor envía: Tema, Competencia, Grado y Contexto 📚"})
+
+    if not await generation_limiter.acquire():
+        return busy_response()
+
+    async def events():
+        try:
+            async for event in generate_lesson_stream(session_id, user_message):
+                yield event
+        except GenerationUnavailable as e:
+            yield sse_event("error", {"error": f"El servicio de generación no está disponible: {e}"})
+        finally:
+            generation_limiter.release()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/batch")
+async def batch(request: Request):
+    """Genera varias sesiones en una llamada. Con "stream": true responde NDJSON a medida
+    que terminan; si no, devuelve 202 con un job_id para consultar en /batch/{job_id}."""
+    try:
+        payload = await request.json()
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict):
+        return JSONResponse({"error": "Envía un JSON con la lista de mensajes en \"messages\" 📚"}, status_code=400)
+
+    items = parse_batch_items(payload)
+    if not items or any(not message for _, message in items):
+        return JSONResponse({"error": "Cada mensaje debe incluir: Tema, Competencia, Grado y Contexto 📚"}, status_code=400)
+    if len(items) > BATCH_MAX_ITEMS:
+        return JSONResponse({"error": f"Máximo {BATCH_MAX_ITEMS} sesiones por lote"}, status_code=413)
+
+    job = create_batch_job(items)
+    job.task = asyncio.create_task(run_batch_job(job))
+    if payload.get("stream"):
+        return StreamingResponse(stream_batch_job(job), media_type="application/x-ndjson")
+    return JSONResponse(job.summary(), status_code=202)
+
+@app.get("/batch/{job_id}")
+def batch_status(job_id: str):
+    job = batch_jobs.get(job_id)
+    if job is None:
+        return JSONResponse({"error": "Lote no encontrado"}, status_code=404)
+    return {**job.summary(), "results": [result for result in job.results if result is not None]}
+
+@app.get("/metrics")
+def metrics():
+    """Métricas en formato de exposición de Prometheus."""
+    cache = lesson_cache.stats()
+    lines = [line for metric in METRICS for line in metric.render()]
+    lines += [
+        "# HELP eduai_lesson_cache_lookups_total Consultas a la caché de sesiones por resultado",
+        "# TYPE eduai_lesson_cache_lookups_total counter",
+        f'eduai_lesson_cache_lookups_total{{result="hit"}} {cache["hits"]}',
+        f'eduai_lesson_cache_lookups_total{{result="near_hit"}} {cache["near_hits"]}',
+        f'eduai_lesson_cache_lookups_total{{result="miss"}} {cache["misses"]}',
+        "# HELP eduai_generations_in_flight Generaciones en curso en este worker",
+        "# TYPE eduai_generations_in_flight gauge",
+        f"eduai_generations_in_flight {generation_limiter.in_flight}",
+    ]
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {**lesson_cache.stats(), "query_embeddings": query_embedder.stats()}
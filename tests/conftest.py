@@ -0,0 +1,22 @@
+"""
+Fixtures compartidas: main.py cargado sin red (índice y SQLite en un directorio
+temporal, currículo de benchmarks/fixtures) y un FakeGenaiClient por prueba.
+
+    python -m pytest -q tests
+"""
+import pytest
+
+from benchmarks.fakes import FakeConfig, FakeGenaiClient
+from benchmarks.harness import load_service
+
+
+@pytest.fixture(scope="session")
+def main():
+    return load_service()
+
+
+@pytest.fixture
+def fake(main, monkeypatch):
+    fake = FakeGenaiClient(FakeConfig(latency=0, first_token=0, embed_latency=0))
+    monkeypatch.setattr(main, "client", fake)
+    return fake
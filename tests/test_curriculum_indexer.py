@@ -0,0 +1,44 @@
+"""
+Ingesta del currículo: cada intento de embeber un lote pasa por el token bucket.
+"""
+from benchmarks.fakes import overloaded_error
+
+
+class CountingBucket:
+    def __init__(self):
+        self.acquired = 0
+
+    def acquire(self):
+        self.acquired += 1
+
+
+class FakeCollection:
+    def __init__(self):
+        self.added = []
+
+    def add(self, ids, embeddings, documents):
+        self.added.extend(ids)
+
+
+def test_ingest_retries_go_back_through_the_token_bucket(main, fake, monkeypatch):
+    monkeypatch.setattr(main.random, "uniform", lambda a, b: 0.001)  # backoff corto
+    embed_content = fake.models.embed_content
+    failures = iter([overloaded_error(), overloaded_error()])
+
+    def overloaded_twice(model, contents, config=None):
+        error = next(failures, None)
+        fake.calls["embed_content"] += error is not None
+        if error is not None:
+            raise error
+        return embed_content(model, contents, config)
+
+    monkeypatch.setattr(fake.models, "embed_content", overloaded_twice)
+    indexer = main.CurriculumIndexer(main.chroma_client)
+    indexer.rate_limiter = CountingBucket()
+    collection = FakeCollection()
+
+    indexer._embed_batch(collection, [("a", "fracciones"), ("b", "ecuaciones")])
+
+    assert collection.added == ["a", "b"]
+    # un intento por cada paso por el bucket: el SDK no reintenta por su cuenta
+    assert fake.calls["embed_content"] == indexer.rate_limiter.acquired == 3
@@ -0,0 +1,146 @@
+"""
+Circuit breaker y hedging del GenerationDispatcher: una llamada de prueba (circuito
+semiabierto) que no llega a un veredicto no debe dejar el modelo bloqueado, y
+cancelar a quien llama no debe dejar llamadas a Gemini huérfanas.
+"""
+import asyncio
+import time
+
+import httpx
+import pytest
+from google.genai import errors
+
+
+def half_open_dispatcher(main):
+    """Dispatcher sin modelo alternativo (configuración por defecto) con el circuito abierto
+    y el cooldown vencido: la próxima llamada es la de prueba."""
+    dispatcher = main.GenerationDispatcher("modelo", "", max_retries=0)
+    breaker = dispatcher.breakers["modelo"]
+    breaker.cooldown = 0
+    for _ in range(breaker.threshold):
+        breaker.failure()
+    assert breaker.state() == "abierto"
+    return dispatcher
+
+
+def test_cancelled_trial_call_releases_the_circuit(main, fake):
+    dispatcher = half_open_dispatcher(main)
+    fake.config.latency = 5
+
+    async def cancel_trial():
+        trial = asyncio.ensure_future(dispatcher.generate_async("prompt"))
+        await asyncio.sleep(0.05)
+        assert dispatcher.breakers["modelo"].state() == "semiabierto"
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+    asyncio.run(cancel_trial())
+    fake.config.latency = 0
+    response = asyncio.run(dispatcher.generate_async("prompt"))
+    assert response.text
+    assert dispatcher.breakers["modelo"].state() == "cerrado"
+
+
+def test_request_error_on_trial_call_releases_the_circuit(main, fake, monkeypatch):
+    dispatcher = half_open_dispatcher(main)
+    generate_content = fake.aio.models.generate_content
+    calls = []
+
+    async def bad_request_once(model, contents, config=None):
+        calls.append(model)
+        if len(calls) == 1:
+            raise errors.ClientError(400, httpx.Response(400, json={"error": {"code": 400, "message": "bad"}}))
+        return await generate_content(model, contents, config)
+
+    monkeypatch.setattr(fake.aio.models, "generate_content", bad_request_once)
+    with pytest.raises(errors.ClientError):
+        asyncio.run(dispatcher.generate_async("prompt"))
+    assert asyncio.run(dispatcher.generate_async("prompt")).text
+    assert dispatcher.breakers["modelo"].state() == "cerrado"
+
+
+def test_failed_trial_call_reopens_the_circuit(main, fake):
+    dispatcher = half_open_dispatcher(main)
+    fake.config.error_rate = 1.0
+    with pytest.raises(main.GenerationUnavailable):
+        asyncio.run(dispatcher.generate_async("prompt"))
+    breaker = dispatcher.breakers["modelo"]
+    assert breaker.state() == "abierto"
+    assert time.monotonic() - breaker.opened_at < 1
+
+
+def hedging_dispatcher(main):
+    """Dispatcher con hedging y un presupuesto ya medido (~10 ms) para el modelo principal."""
+    dispatcher = main.GenerationDispatcher(
+        "modelo", "", max_retries=0, hedge=True, budget=main.LatencyBudget(0.9, min_samples=1),
+    )
+    dispatcher.latency.observe(("modelo", "lesson"), 0.01)
+    return dispatcher
+
+
+def test_cancelling_the_caller_cancels_the_hedged_call(main, fake):
+    dispatcher = hedging_dispatcher(main)
+    dispatcher.latency.observe(("modelo", "lesson"), 5)  # el presupuesto supera la espera de la prueba
+    dispatcher.latency.min_samples = 2
+    fake.config.latency = 5
+    calls = main.GENERATION_CALLS._values
+    ok_before = calls.get(("modelo", "ok"), 0)
+    cancelled_before = calls.get(("modelo", "cancelled"), 0)
+
+    async def cancel_during_budget_wait():
+        caller = asyncio.ensure_future(dispatcher.generate_async("prompt"))
+        await asyncio.sleep(0.05)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        await asyncio.sleep(0.01)  # deja que las tareas canceladas terminen
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task() and not task.done()]
+
+    assert asyncio.run(cancel_during_budget_wait()) == []
+    assert calls.get(("modelo", "ok"), 0) == ok_before
+    assert calls.get(("modelo", "cancelled"), 0) == cancelled_before + 1
+
+
+def test_hedge_to_the_same_model_goes_through_its_breaker(main, fake):
+    dispatcher = hedging_dispatcher(main)
+    breaker = dispatcher.breakers["modelo"]
+    assert dispatcher._hedge_model("modelo") == "modelo"
+
+    breaker.cooldown = 0
+    for _ in range(breaker.threshold):
+        breaker.failure()
+    assert breaker.allow()  # la llamada de prueba del circuito semiabierto
+    assert dispatcher._hedge_model("modelo") is None
+
+
+def test_generate_lesson_uses_the_sync_client(main, fake, monkeypatch):
+    """client.aio no sobrevive entre asyncio.run sucesivos: generate_lesson no debe tocarlo."""
+    from benchmarks.harness import teacher_message
+
+    async def bound_to_a_closed_loop(*args, **kwargs):
+        raise RuntimeError("Event loop is closed")
+
+    monkeypatch.setattr(fake.aio.models, "generate_content", bound_to_a_closed_loop)
+    monkeypatch.setattr(main.lesson_cache, "max_size", 0)  # cada llamada llega a Gemini
+    for i in range(2):
+        lesson = main.generate_lesson(f"script-{i}", teacher_message(i))
+        assert "error" not in lesson
+    assert fake.calls["generate_content"] == 2
+
+
+def test_sync_generate_retries_then_opens_the_circuit(main, fake, monkeypatch):
+    monkeypatch.setattr(main.random, "uniform", lambda a, b: 0.001)  # backoff corto
+    dispatcher = main.GenerationDispatcher("modelo", "", max_retries=2)
+    fake.config.error_rate = 1.0
+    with pytest.raises(main.GenerationUnavailable):
+        dispatcher.generate("prompt")
+    assert fake.calls["generate_content"] == 3
+
+    breaker = dispatcher.breakers["modelo"]
+    for _ in range(breaker.threshold - 3):
+        breaker.failure()
+    assert breaker.state() == "abierto"
+    fake.config.error_rate = 0
+    with pytest.raises(main.GenerationUnavailable, match="Circuito abierto"):
+        dispatcher.generate("prompt")
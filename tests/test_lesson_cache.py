@@ -0,0 +1,25 @@
+"""
+Caché de sesiones: qué se guarda para reutilizar.
+"""
+from benchmarks.harness import teacher_message
+
+
+def test_lesson_generated_before_the_index_is_published_is_not_cached(main, fake, monkeypatch):
+    monkeypatch.setattr(main.curriculum_indexer, "active", None)
+    message = teacher_message(1, titulo="Tema sin índice")
+    entries = main.lesson_cache.stats()["entries"]
+
+    main.generate_lesson("arranque-1", message)
+    main.generate_lesson("arranque-2", message)
+
+    assert main.lesson_cache.stats()["entries"] == entries
+    assert fake.calls["generate_content"] == 2  # la segunda también se generó
+
+
+def test_lesson_generated_with_curriculum_fragments_is_cached(main, fake):
+    message = teacher_message(2, titulo="Tema con índice")
+
+    main.generate_lesson("listo-1", message)
+    main.generate_lesson("listo-2", message)
+
+    assert fake.calls["generate_content"] == 1
@@ -0,0 +1,83 @@
+"""
+Limpieza y reparación de la salida del modelo: code-fences, texto extra, saltos de
+línea sin escapar y salidas truncadas; y qué secciones quedan por regenerar.
+"""
+import pytest
+
+from benchmarks.fakes import ERROR_SAMPLE_RAW
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ('```json\n{"tema": "Fracciones"}\n```', {"tema": "Fracciones"}),
+    ('Aquí tienes la sesión:\n{"tema": "Fracciones"}\nEspero que te sirva.', {"tema": "Fracciones"}),
+    ('{"tema": "Fracciones",\n "horasClase": 2}} texto con } y {', {"tema": "Fracciones", "horasClase": 2}),
+    ('{"tema": "Línea uno\nlínea dos"}', {"tema": "Línea uno\nlínea dos"}),
+    ('{"tema": "dice \\"hola\\"", "lista": [1, 2,]}', {"tema": 'dice "hola"', "lista": [1, 2]}),
+])
+def test_clean_model_output_parses_complete_objects(main, raw, expected):
+    obj, _ = main.clean_model_output(raw)
+    assert obj == expected
+
+
+@pytest.mark.parametrize("raw, expected", [
+    # dentro de un string: se cierra y se conserva lo recibido
+    ('{"tema": "Fracc', {"tema": "Fracc"}),
+    # dentro de una clave: se descarta la clave a medias
+    ('{"tema": "Fracciones", "horasCl', {"tema": "Fracciones"}),
+    # tras los dos puntos: la clave no tiene valor todavía
+    ('{"tema": "Fracciones", "horasClase":', {"tema": "Fracciones"}),
+    ('{"tema": "Fracciones", "horasClase": ', {"tema": "Fracciones"}),
+    # dentro de una lista anidada
+    ('{"recursos": {"ideas": ["uno", {"paso": "dos"}, "tr', {"recursos": {"ideas": ["uno", {"paso": "dos"}, "tr"]}}),
+    ('{"recursos": {"ideas": ["uno", ', {"recursos": {"ideas": ["uno"]}}),
+    # justo tras una barra de escape: el string no se puede cerrar, se descarta
+    ('{"tema": "Fracciones", "nota": "dice \\', {"tema": "Fracciones"}),
+])
+def test_clean_model_output_repairs_truncated_output(main, raw, expected):
+    obj, candidate = main.clean_model_output("```json\n" + raw)
+    assert obj == expected
+    assert candidate == main.repair_json(raw)
+
+
+def test_clean_model_output_without_an_object(main):
+    assert main.clean_model_output("Lo siento, no puedo ayudarte.") == (None, "Lo siento, no puedo ayudarte.")
+    assert main.clean_model_output(None) == (None, None)
+
+
+def test_error_sample_only_needs_its_broken_resources(main):
+    lesson_json = main.parse_lesson_output(ERROR_SAMPLE_RAW)
+    assert "error" not in lesson_json
+    assert main.invalid_sections(lesson_json) == [
+        "recursosAdicionales.problemasYEjercicios",
+        "recursosAdicionales.juegoDidactico",
+        "recursosAdicionales.actividadDeActivacion",
+        "recursosAdicionales.evaluacionFormativa",
+        "recursosAdicionales.actividadesDiferenciadas",
+    ]
+
+
+def test_parse_lesson_output_rejects_objects_without_lesson_sections(main):
+    lesson_json = main.parse_lesson_output('{"respuesta": "Lo siento"}')
+    assert lesson_json["error"] == main.LESSON_PARSE_ERROR
+    assert main.invalid_sections(lesson_json) == []
+
+
+def test_merge_sections_writes_only_the_requested_paths(main):
+    lesson_json = {"tema": "Fracciones", "recursosAdicionales": {"fichasDeTrabajo": "vieja"}}
+    raw = '```json\n{"tema": "Otro", "recursosAdicionales": {"fichasDeTrabajo": "nueva", "juegoDidactico": "x"}}\n```'
+    paths = ["recursosAdicionales.fichasDeTrabajo"]
+    assert main.merge_sections(lesson_json, raw, paths) is True
+    assert lesson_json == {"tema": "Fracciones", "recursosAdicionales": {"fichasDeTrabajo": "nueva"}}
+
+
+@pytest.mark.parametrize("raw", [
+    "Lo siento, no puedo generar esas secciones.",
+    '{"respuesta": "Lo siento"}',
+    '{"recursosAdicionales": {"juegoDidactico": "no pedido"}}',
+])
+def test_merge_sections_reports_unusable_output(main, raw):
+    lesson_json = {"tema": "Fracciones"}
+    failures = main.PARSE_FAILURES._values.get((), 0)
+    assert main.merge_sections(lesson_json, raw, ["tema", "recursosAdicionales.fichasDeTrabajo"]) is False
+    assert lesson_json == {"tema": "Fracciones"}
+    assert main.PARSE_FAILURES._values.get((), 0) == failures + 1
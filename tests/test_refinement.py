@@ -0,0 +1,67 @@
+"""
+Detección de seguimientos: qué campos del docente cambia un mensaje y qué
+secciones hay que regenerar.
+"""
+import pytest
+
+FICHA = "recursosAdicionales.fichasDeTrabajo"
+PROBLEMAS = "recursosAdicionales.problemasYEjercicios"
+
+
+@pytest.mark.parametrize("message, changes", [
+    ("cambia el contexto a pesquero", {"contexto": "Pesquero"}),
+    ("Contexto: Minero", {"contexto": "Minero"}),
+    ("quiero más problemas para el contexto urbano", {"contexto": "Urbano"}),
+    ("Duración: 90 minutos y agrega más preguntas", {"duracion": "90 minutos"}),
+    ("pon la duración en 2 horas", {"duracion": "2 horas"}),
+    ("cambia el tema a Porcentajes, por favor", {"titulo": "Porcentajes"}),
+    ("que el grado sea 3º de secundaria", {"grado": "3º de secundaria"}),
+    ("usa materiales: regla", {"materiales": "Regla"}),
+    ("cambia el enfoque transversal por Enfoque Intercultural", {"enfoque_transversal": "Enfoque Intercultural"}),
+])
+def test_field_changes_detects_explicit_changes(main, message, changes):
+    assert main.field_changes(message) == changes
+
+
+@pytest.mark.parametrize("message", [
+    "el grado al que va dirigido está bien, cambia la ficha",
+    "el tema a tratar es difícil, simplifica los problemas",
+    "Haz el juego más corto",
+    "hazlo más divertido",
+])
+def test_field_changes_ignores_mentions_without_a_change(main, message):
+    assert main.field_changes(message) == {}
+
+
+def test_refinement_paths_keeps_a_one_section_edit_small(main):
+    message = "el grado al que va dirigido está bien, cambia la ficha"
+    assert main.refinement_paths(message, main.field_changes(message)) == [FICHA]
+
+
+def test_refinement_paths_adds_the_sections_of_a_changed_field(main):
+    message = "quiero más problemas para el contexto urbano"
+    paths = main.refinement_paths(message, main.field_changes(message))
+    assert paths[0] == PROBLEMAS
+    assert {"contexto", "actividadesContextualizadas", FICHA} <= set(paths)
+    assert "datosGenerales" not in paths
+
+
+def test_refinement_paths_collapses_subsections_into_their_section(main):
+    # el cambio de tema regenera recursosAdicionales completo: el juego ya va incluido
+    paths = main.refinement_paths("cambia el tema a Porcentajes y acorta el juego", {"titulo": "Porcentajes"})
+    assert "recursosAdicionales" in paths
+    assert not [path for path in paths if path.startswith("recursosAdicionales.")]
+    assert len(paths) == len(set(paths))
+
+
+def test_refinement_paths_regenerates_everything_when_nothing_is_recognized(main):
+    assert main.refinement_paths("hazlo más divertido", {}) == list(main.ALL_SECTIONS)
+
+
+def test_plan_refinement_ignores_a_change_to_the_current_value(main, fake):
+    from benchmarks.harness import teacher_message
+
+    main.generate_lesson("seguimiento", teacher_message(0, contexto="Urbano"))
+    inputs, _, paths = main.plan_refinement("seguimiento", "cambia el contexto a urbano y acorta la ficha")
+    assert inputs["contexto"] == "Urbano"
+    assert paths == [FICHA]
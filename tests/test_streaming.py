@@ -0,0 +1,54 @@
+"""
+IncrementalSectionParser: cada sección de primer nivel se entrega en cuanto su valor
+termina, sin importar dónde corte el stream los trozos.
+"""
+import json
+
+import pytest
+
+from benchmarks.fakes import EXAMPLE_LESSON_TEXT
+
+TRICKY = {
+    "tema": 'El "mercado" del barrio',
+    "propositoSesion": "Usar }, ] y , dentro de un texto: {no es JSON}",
+    "secuenciaMetodologica": {"inicio": ["dice \\\"hola\\\"", "barra \\ final\\"], "cierre": "fin}"},
+    "horasClase": 2,
+    "nota": "última",
+}
+
+
+def feed_in_chunks(main, text, size):
+    parser = main.IncrementalSectionParser()
+    sections = []
+    for start in range(0, len(text), size):
+        sections.extend(parser.feed(text[start:start + size]))
+    return sections
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64])
+def test_sections_survive_any_chunk_boundary(main, size):
+    text = "```json\n" + json.dumps(TRICKY, ensure_ascii=False, indent=2) + "\n```"
+    assert feed_in_chunks(main, text, size) == list(TRICKY.items())
+
+
+@pytest.mark.parametrize("split", ['\\', '"', "}", ","])
+def test_split_right_at_a_character_inside_a_string(main, split):
+    text = json.dumps(TRICKY, ensure_ascii=False)
+    parser = main.IncrementalSectionParser()
+    cut = text.index(split, text.index('"propositoSesion"') + len('"propositoSesion": "'))
+    sections = parser.feed(text[:cut]) + parser.feed(text[cut:cut + 1]) + parser.feed(text[cut + 1:])
+    assert sections == list(TRICKY.items())
+
+
+def test_each_section_is_delivered_as_soon_as_it_ends(main):
+    parser = main.IncrementalSectionParser()
+    assert parser.feed('{"tema": "Fracciones", "horasClase": ') == [("tema", "Fracciones")]
+    assert parser.feed("2") == []
+    assert parser.feed(', "cierre": {"a": "}"') == [("horasClase", 2)]
+    assert parser.feed("}}") == [("cierre", {"a": "}"})]
+    assert parser.feed(' texto posterior {"ignorado": 1}') == []
+
+
+def test_example_lesson_matches_the_full_parse(main):
+    sections = feed_in_chunks(main, EXAMPLE_LESSON_TEXT, 5)
+    assert dict(sections) == json.loads(EXAMPLE_LESSON_TEXT[EXAMPLE_LESSON_TEXT.index("{"):])